@@ -10,12 +10,16 @@ This script orchestrates the entire data pipeline:
 
 import os
 import time
+import atexit
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 import logging
-from coffee_copilot.database import init_db, get_session
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from coffee_copilot.database import init_db, get_session, optimize_db, engine
 from sqlalchemy import text
 from coffee_copilot.app import main as scrape_products
-from coffee_copilot.enhance_products import enhance_products
+from coffee_copilot.enhance_products import enhance_products, batch_mode_enabled
 from coffee_copilot.recommend_coffee import CoffeeRecommender
 from coffee_copilot.order_manager import add_coffee_order
 
@@ -23,15 +27,46 @@ from coffee_copilot.order_manager import add_coffee_order
 log_dir = os.path.join(os.path.dirname(__file__), 'logs')
 os.makedirs(log_dir, exist_ok=True)
 
-# Set up logging
+# Set up logging; records are formatted and queued here, and a listener thread writes them to the file and stream
+log_queue = queue.Queue()
+log_listener = QueueListener(
+    log_queue,
+    RotatingFileHandler(os.path.join(log_dir, 'pipeline.log'), maxBytes=1_000_000, backupCount=3, delay=True),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(log_dir, 'pipeline.log')),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# How long enhancement waits for the scraper to commit more products before checking again
+ENHANCE_POLL_SECONDS = 5
+
+def scrape_and_enhance():
+    """Scrape in a background thread while enhancing each roaster's products as they are committed
+
+    In batch mode every round would submit its own Batch API job and wait up to 24 hours on it,
+    so enhancement instead waits for the scrape and sends every product in one job.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        scrape = executor.submit(scrape_products)  # This function handles its own database initialization
+        if batch_mode_enabled():
+            scrape.result()
+            enhance_products(use_batch=True)
+            return
+        while True:
+            # A round that starts after scraping has finished sees every product, so it is the last
+            scrape_finished = scrape.done()
+            enhanced = enhance_products()
+            if scrape_finished:
+                break
+            if not enhanced:
+                wait([scrape], timeout=ENHANCE_POLL_SECONDS)
+        # Re-raise anything the scraper failed with
+        scrape.result()
 
 def run_pipeline():
     """Run the complete data pipeline"""
@@ -44,29 +79,28 @@ def run_pipeline():
         logging.info("Initializing database...")
         init_db()
         
-        # Step 2: Scrape Products
-        logging.info("Scraping products from roasters...")
-        scrape_products()  # This function handles its own database initialization
+        # Steps 2 and 3: Scrape Products, enhancing them with AI extraction as each roaster is stored
+        logging.info("Scraping products from roasters and enhancing them with AI extraction...")
+        scrape_and_enhance()
+        
+        # The scrape rewrote most tables, so refresh the query planner's statistics before reading them
+        optimize_db(engine)
         
         # Get a database session
         session = get_session()
         
         try:
             # Count products in the beans view
-            beans_count = session.execute(text('SELECT COUNT(*) FROM whole_beans_view')).scalar()
+            beans_count = session.execute(text('SELECT COUNT(*) FROM whole_beans_mat')).scalar()
             logging.info(f"Found {beans_count} coffee products in the whole beans view")
             
-            # Step 3: Enhance Products
-            logging.info("Enhancing products with AI extraction...")
-            enhance_products()
-            
             # Step 4: Get Coffee Recommendation
             logging.info("\nGetting coffee recommendation...")
             recommender = CoffeeRecommender()
             
             # Get and display spending summary
             history = recommender.get_order_history()
-            spending = recommender.get_spending_summary(history)
+            spending = recommender.get_spending_summary()
             
             print("\nSpending Summary:")
             print("-" * 50)
@@ -77,9 +111,7 @@ def run_pipeline():
             # Display recent orders
             print("\nRecent Orders:")
             print("-" * 50)
-            for coffee in history[:5]:
-                order_date = recommender.parse_date(coffee['order_date']).strftime('%Y-%m-%d')
-                print(f"{order_date}: {coffee['roaster_name']} - {coffee['parent_title']} (${coffee['price']:.2f})")
+            print("\n".join(recommender.format_recent_orders(history)))
             
             # Get and display recommendation
             print("\nRecommended Coffee:")
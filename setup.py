@@ -12,7 +12,11 @@ setup(
         "python-dotenv",
         "pyyaml",
         "beautifulsoup4",
-        "requests"
+        "lxml",
+        "selectolax",
+        "orjson",
+        "requests",
+        "httpx"
     ],
-    python_requires=">=3.8",
+    python_requires=">=3.9",
 )
@@ -1,276 +1,672 @@
 from typing import Dict, List, Optional
+import asyncio
+import copy
+import html
 import json
 import os
-import requests
-from bs4 import BeautifulSoup
-from openai import AzureOpenAI
-import yaml
-from dotenv import load_dotenv
-from tenacity import retry, stop_after_attempt, wait_exponential
+import re
+import tempfile
+import time
+import httpx
+from bs4 import BeautifulSoup, SoupStrainer
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from io import BytesIO
 from PIL import Image
 import base64
+import hashlib
 from datetime import datetime
 import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from coffee_copilot import llm_cache, prompt_log
+from coffee_copilot.config import get_config
+from coffee_copilot.openai_client import get_client, create_async_client
+
+# Prefer the C-backed lxml parser, falling back to the stdlib parser if it isn't installed
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# selectolax's lexbor engine parses without building Python objects per node; BeautifulSoup is the fallback
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+# orjson parses the JSON responses several times faster; stdlib json is the fallback
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Only these Azure errors are worth backing off and retrying; anything else fails fast
+TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# Shared pool for cleaning scraped pages alongside the description, so threads aren't spawned per product
+CLEAN_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='clean_html')
+
+# Batch API jobs are polled from this interval, doubling up to the maximum
+BATCH_POLL_SECONDS = 30
+BATCH_POLL_MAX_SECONDS = 600
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Default cap on each prompt section, in characters
+MAX_SECTION_CHARS = 4000
+TRUNCATED_MARKER = "[…truncated]"
+
+# Every extraction result has these fields; missing ones take these defaults
+EMPTY_RESULT_TEMPLATE = {
+    "is_single_origin": None,
+    "origin": {
+        "country": None,
+        "region": None
+    },
+    "roast_level": None,
+    "processing_method": None,
+    "varietals": [],
+    "altitude": None,
+    "farm": None,
+    "producer": None,
+    "resting_period_days": None,
+    "tasting_notes": {
+        "fruits": [],
+        "sweets": [],
+        "florals": [],
+        "spices": [],
+        "others": []
+    },
+    "confidence_score": 0.0
+}
+
+# Field schema and resting guidelines for the extraction prompt
+EXTRACTION_FIELDS = """- is_single_origin: true/false/null (if unclear)
+  - true if it's from one specific farm, producer, or region
+  - false if it contains the word "blend" or mentions multiple origins
+  - null if unclear
+- origin: {"country": string/null, "region": string/null}
+- roast_level: string/null
+- processing_method: string/null, format Proper case, primary; secondary; other where primary is "Washed", "Natural", "Honey", and secondary/other contain information about fermentation or experimental process elements.
+- varietals: list of strings, may also be called cultivars
+- altitude: string/null, format XXXX-YYYY if a range, or XXXX if a single value. Convert to masl if necessary, then remove units.
+- farm: string/null
+- producer: string/null, producer refers to the bean producer, not the local roaster.
+- tasting_notes: {
+    "fruits": list of strings,
+    "sweets": list of strings,
+    "florals": list of strings,
+    "spices": list of strings,
+    "others": list of strings
+}
+- confidence_score: float (0-1)
+
+Also estimate a recommended resting period in days based on these guidelines:
+- Natural/honey process: 10-14 days
+- Washed process: 7-10 days
+- Darker/Espresso roasts: Subtract 2-3 days
+- Lighter/Filter roasts: Add 2-3 days
+- African varietals (SL28, SL34, Ruiru 11, Batian): Add 1-2 days
+- Dense beans (high altitude >1600m): Add 1-2 days
+Return this as resting_period_days in the JSON.
+"""
+
+# Static instructions sent as the system message. Keep these byte-identical between
+# calls (no interpolation) so Azure can reuse its cached prompt prefix.
+SYSTEM_PROMPT = "\n".join([
+    "Extract coffee product details from the text provided by the user. Pay special attention to the PRODUCT TITLE for determining if this is a blend or single origin coffee, and consider any details visible in the product image if one is attached.",
+    "Attempt to identify the origin, processing method, varietals, altitude, farm, producer, and tasting notes.",
+    "You are provided shop data, a scraped html page, and possibly the product image in order to extract this information.",
+    "Extract information specific to the product, ignoring any superfluous information from the image or shop data.",
+    "Return a JSON object with these fields:",
+    EXTRACTION_FIELDS
+])
+
+# Matches any class containing 'desc' (description, product-desc, etc.)
+DESC_RE = re.compile(r'desc', re.IGNORECASE)
+
+# Only description divs are used, so skip building the rest of the page tree
+DESC_STRAINER = SoupStrainer('div', class_=DESC_RE)
+
+# Shopify descriptions are mostly text with light markup; regex-strip those and only parse the complex ones
+TAG_RE = re.compile(r'<[^>]+>')
+BLOCK_BREAK_RE = re.compile(r'<(?:br|/p|/li|/h[1-6]|/div)\b[^>]*>', re.IGNORECASE)
+COMPLEX_HTML_RE = re.compile(r'<(script|style|table|svg)\b', re.IGNORECASE)
 
 class AICoffeeExtractor:
     def __init__(self):
         """Initialize the AI-based coffee data extractor"""
-        # Load environment variables
-        load_dotenv()
-        
         # Load config
-        with open('config.yaml', 'r') as f:
-            self.config = yaml.safe_load(f)
-            self.ai_config = self.config['ai']
-            self.image_config = self.config['image_processing']
-
-        # Initialize Azure OpenAI client
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+        self.config = get_config()
+        self.ai_config = self.config['ai']
+        self.image_config = self.config['image_processing']
+
+        # Initialize Azure OpenAI clients (the sync client and its connection pool are shared)
+        self.client = get_client()
+        self.async_client = create_async_client()
+        self._http = httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(15.0, connect=5.0))
+        
+        # Limit in-flight requests when many products are extracted concurrently
+        self.max_concurrency = self.ai_config.get('max_concurrency', 10)
+        # The semaphore and rate lock are built by _bind_event_loop on the loop that uses them
+        self._sem = None
+        self._async_loop = None
+        self._loop = None
+        
+        # Request starts are spaced out to stay under the deployment's requests-per-minute quota
+        requests_per_minute = self.ai_config.get('requests_per_minute', 0)
+        self.min_request_interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._rate_lock = None
+        self._next_request_at = 0.0
         
         self.deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT")
         self.temperature = self.ai_config['azure']['temperature']
         self.max_retries = self.ai_config['max_retries']
+        self.cache_ttl_days = self.ai_config.get('cache_ttl_days', llm_cache.DEFAULT_TTL_DAYS)
+        self.max_section_chars = self.ai_config.get('max_section_chars', MAX_SECTION_CHARS)
         
-        # Create prompt logs directory
+        # Create prompt logs directory (prompts are only dumped with PROMPT_LOG=1)
+        self.prompt_log_enabled = os.getenv("PROMPT_LOG", "0") == "1"
         self.prompt_log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'prompts', 'extractions')
         os.makedirs(self.prompt_log_dir, exist_ok=True)
         
+        # Create image cache directory
+        self.image_cache_enabled = self.image_config.get('cache_enabled', True)
+        self.image_cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'image_cache')
+        if self.image_cache_enabled:
+            os.makedirs(self.image_cache_dir, exist_ok=True)
+        
+    @classmethod
+    @lru_cache(maxsize=1)
+    def get(cls) -> 'AICoffeeExtractor':
+        """Return the shared extractor, so config and HTTP connection pools are reused"""
+        return cls()
+
+    def run(self, coro):
+        """Run a coroutine to completion on the extractor's own event loop
+
+        Sync callers all share this loop, so the async clients are bound to it once and
+        their connections are reused from one call to the next.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    async def _bind_event_loop(self):
+        """Rebuild the async clients, semaphore and rate lock when called from a new event loop
+
+        These are tied to the loop they are first used on. The semaphore and lock are
+        built on every new loop, since before Python 3.10 they bind to the loop that was
+        current when they were created. The old clients are closed so their connection
+        pools aren't left open.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_loop is loop:
+            return
+        previous_loop, self._async_loop = self._async_loop, loop
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        self._rate_lock = asyncio.Lock()
+        if previous_loop is None:
+            return
+        
+        old_client, old_http = self.async_client, self._http
+        self.async_client = create_async_client()
+        self._http = httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(15.0, connect=5.0))
+        
+        # Connections opened on a loop that has since closed can't be shut down cleanly, and go with it
+        for close in (old_client.close, old_http.aclose):
+            try:
+                await close()
+            except Exception:
+                pass
+
+    async def _throttle(self):
+        """Wait for the next request slot under ai.requests_per_minute"""
+        if not self.min_request_interval:
+            return
+        
+        async with self._rate_lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next_request_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_request_at = max(loop.time(), self._next_request_at) + self.min_request_interval
+
     def _clean_html(self, html_content: str) -> str:
         """Clean HTML content and extract text"""
         if not html_content:
             return ""
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Remove script and style elements
-        for script in soup(['script', 'style']):
-            script.decompose()
-            
-        # Find all divs with 'desc' in their class name (catches description, desc, etc.)
-        desc_divs = soup.find_all('div', class_=lambda x: x and 'desc' in x.lower())
-        
-        # Only use description divs, no fallback
+
+        # Reuse the cleaned text if we've seen this exact page before
+        cache_key = llm_cache.make_key(kind="clean_html", html=html_content)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Only use text from divs with 'desc' in their class name (catches description, desc, etc.), no fallback
         text = []
-        for div in desc_divs:
+        for div_text in self._desc_div_texts(html_content):
             # Keep line breaks for structure
-            lines = [line.strip() for line in div.get_text().split('\n') if line.strip()]
-            text.extend(lines)
-        return '\n'.join(text)
+            text.extend(line for line in map(str.strip, div_text.splitlines()) if line)
+
+        cleaned = '\n'.join(text)
+        llm_cache.set(cache_key, cleaned, self.cache_ttl_days)
+        return cleaned
+
+    def _strip_html(self, html_content: str) -> str:
+        """Reduce a product description's HTML to its text lines"""
+        if not html_content:
+            return ""
+
+        if COMPLEX_HTML_RE.search(html_content):
+            raw_text = self._parsed_text(html_content)
+        else:
+            raw_text = html.unescape(TAG_RE.sub(' ', BLOCK_BREAK_RE.sub('\n', html_content)))
+
+        # Collapse the whitespace left by removed tags, keeping one line per block
+        return '\n'.join(line for line in (' '.join(raw.split()) for raw in raw_text.splitlines()) if line)
+
+    def _parsed_text(self, html_content: str) -> str:
+        """Return all of a document's text, one text node per line, with script and style elements removed"""
+        if LexborHTMLParser is not None:
+            tree = LexborHTMLParser(html_content)
+            for node in tree.css('script, style'):
+                node.decompose()
+            return tree.body.text(separator='\n') if tree.body else ''
+
+        soup = BeautifulSoup(html_content, HTML_PARSER)
+        for script in soup(['script', 'style']):
+            script.decompose()
+        return soup.get_text('\n')
+
+    def _desc_div_texts(self, html_content: str) -> List[str]:
+        """Return the text of each description div, with script and style elements removed"""
+        if LexborHTMLParser is not None:
+            tree = LexborHTMLParser(html_content)
+            for node in tree.css('script, style'):
+                node.decompose()
+            return [div.text() for div in tree.css('div[class*="desc" i]')]
+
+        soup = BeautifulSoup(html_content, HTML_PARSER, parse_only=DESC_STRAINER)
+        for script in soup(['script', 'style']):
+            script.decompose()
+        return [div.get_text() for div in soup.find_all('div', class_=DESC_RE)]
 
     def _get_empty_result(self) -> Dict:
         """Return an empty result structure"""
-        return {
-            "is_single_origin": None,
-            "origin": {
-                "country": None,
-                "region": None
-            },
-            "roast_level": None,
-            "processing_method": None,
-            "varietals": [],
-            "altitude": None,
-            "farm": None,
-            "producer": None,
-            "tasting_notes": {
-                "fruits": [],
-                "sweets": [],
-                "florals": [],
-                "spices": [],
-                "others": []
-            },
-            "confidence_score": 0.0
-        }
+        return copy.deepcopy(EMPTY_RESULT_TEMPLATE)
+
+    def _normalize_result(self, response: Dict) -> Dict:
+        """Ensure all expected fields exist on an extraction result"""
+        merged = copy.deepcopy(EMPTY_RESULT_TEMPLATE)
+        merged.update(response)
+        return merged
+
+    def _build_product_text(self, body_html: str, tags: List[str] = None, scraped_html: str = None, parent_title: str = None) -> List[str]:
+        """Combine the available product sources into labelled prompt sections"""
+        text = []
+        
+        # Add parent title if available
+        if parent_title:
+            text.append("=== PRODUCT TITLE ===")
+            text.append(parent_title)
+        
+        # Clean the scraped page in the background while the description is stripped here
+        scraped_future = CLEAN_EXECUTOR.submit(self._clean_html, scraped_html) if scraped_html else None
+        
+        # Add body_html as plain text
+        body_text = self._strip_html(body_html)
+        if body_text:
+            text.append("\n=== SHOPIFY PRODUCT DESCRIPTION ===")
+            text.append(self._truncate(body_text))
+        
+        # Add scraped HTML content if available, minus lines the description already covers
+        if scraped_future:
+            body_lines = set(body_text.splitlines())
+            scraped_lines = [line for line in dict.fromkeys(scraped_future.result().splitlines()) if ' '.join(line.split()) not in body_lines]
+            if scraped_lines:
+                text.append("\n=== SCRAPED PRODUCT PAGE CONTENT ===")
+                text.append(self._truncate('\n'.join(scraped_lines)))
+        
+        # Add tags
+        if tags:
+            text.append("\n=== PRODUCT TAGS ===")
+            text.append(f"Tags: {', '.join(tags)}")
+        return text
 
-    def _downsample_image(self, image_url: str) -> str:
+    def _truncate(self, section: str) -> str:
+        """Cap a prompt section at max_section_chars"""
+        if len(section) <= self.max_section_chars:
+            return section
+        return f"{section[:self.max_section_chars]}\n{TRUNCATED_MARKER}"
+
+    async def _downsample_image(self, image_url: str) -> str:
         """Download, downsample maintaining aspect ratio, and convert image to base64"""
+        # Reuse a previously downsampled copy of this image if we have one
+        # (keyed on the output settings too, so changing them re-renders)
+        cache_path = None
+        if self.image_cache_enabled:
+            cache_source = f"{image_url}|{self.image_config['target_height']}|{self.image_config['jpeg_quality']}"
+            key = hashlib.sha256(cache_source.encode('utf-8')).hexdigest()
+            cache_path = os.path.join(self.image_cache_dir, f"{key}.b64")
+            if os.path.exists(cache_path):
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    return f.read()
+        
         try:
-            # Get config values
-            target_height = self.image_config['target_height']
-            jpeg_quality = self.image_config['jpeg_quality']
-            
-            # Download image
-            response = requests.get(image_url)
-            response.raise_for_status()
-            
-            # Open image
-            img = Image.open(BytesIO(response.content))
-            img = img.convert('RGB')  # Convert to RGB to ensure JPEG compatibility
+            max_bytes = self.image_config.get('max_bytes', 5_000_000)
             
-            # Calculate new width to maintain aspect ratio
-            aspect_ratio = img.width / img.height
-            new_width = int(target_height * aspect_ratio)
+            # Stream the download so oversized images are abandoned early
+            buffer = BytesIO()
+            total = 0
+            async with self._http.stream('GET', image_url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(65536):
+                    total += len(chunk)
+                    if total > max_bytes:
+                        raise ValueError(f"image too large (over {max_bytes} bytes)")
+                    buffer.write(chunk)
             
-            # Resize image maintaining aspect ratio
-            img = img.resize((new_width, target_height), Image.Resampling.LANCZOS)
+            # Resizing is CPU-bound, so keep it off the event loop
+            base64_image = await asyncio.to_thread(self._encode_image, buffer)
             
-            # Save to BytesIO in JPEG format with compression
-            output = BytesIO()
-            img.save(output, format='JPEG', quality=jpeg_quality, optimize=True)
-            output.seek(0)
-            
-            # Convert to base64
-            base64_image = base64.b64encode(output.getvalue()).decode('utf-8')
-            return f"data:image/jpeg;base64,{base64_image}"
+            if cache_path:
+                with open(cache_path, 'w', encoding='utf-8') as f:
+                    f.write(base64_image)
+            return base64_image
             
         except Exception as e:
             print(f"Error processing image: {str(e)}")
             return None
 
+    def _encode_image(self, buffer: BytesIO) -> str:
+        """Downsample downloaded image data and return it as a base64 JPEG data URL"""
+        # Get config values
+        target_height = self.image_config['target_height']
+        jpeg_quality = self.image_config['jpeg_quality']
+        
+        # Open image
+        buffer.seek(0)
+        img = Image.open(buffer)
+        
+        # Let libjpeg decode large JPEGs at a reduced scale (still at least 2x the target)
+        try:
+            img.draft('RGB', (target_height * 2 * img.width // img.height, target_height * 2))
+        except Exception:
+            pass
+        img = img.convert('RGB')  # Convert to RGB to ensure JPEG compatibility
+        
+        # Calculate new width to maintain aspect ratio
+        aspect_ratio = img.width / img.height
+        new_width = int(target_height * aspect_ratio)
+        
+        # Resize image maintaining aspect ratio
+        img = img.resize((new_width, target_height), Image.Resampling.LANCZOS)
+        
+        # Save to BytesIO in JPEG format with compression
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=jpeg_quality, optimize=True)
+        output.seek(0)
+        
+        # Convert to base64
+        base64_image = base64.b64encode(output.getvalue()).decode('utf-8')
+        return f"data:image/jpeg;base64,{base64_image}"
+
     def _dump_prompt(self, prompt: str, title: str):
-        """Dump prompt to a file for debugging"""
+        """Queue a prompt dump to a file for debugging"""
+        if not self.prompt_log_enabled:
+            return
+
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).strip()
         filename = f"{self.prompt_log_dir}/{timestamp}_{safe_title}.txt"
-        
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(f"Product: {title}\n")
-            f.write("="*80 + "\n\n")
-            f.write(prompt)
-            
-        print(f"Prompt dumped to: {filename}")
+        body = f"Product: {title}\n" + "="*80 + "\n\n" + prompt
+        prompt_log.write(filename, body)
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=60, min=60, max=180))
     def extract_coffee_data(self, body_html: str, tags: List[str] = None, scraped_html: str = None, parent_title: str = None, image_url: str = None) -> Dict:
         """Extract structured coffee data from product description using Azure OpenAI"""
+        return self.run(self.extract_coffee_data_async(
+            body_html=body_html,
+            tags=tags,
+            scraped_html=scraped_html,
+            parent_title=parent_title,
+            image_url=image_url
+        ))
+
+    async def extract_coffee_data_many_async(self, items: List[Dict]) -> List[Optional[Dict]]:
+        """Extract several products concurrently, bounded by ai.max_concurrency
+
+        Each item is a dict of extract_coffee_data_async keyword arguments. A product whose
+        extraction fails, including after its retries run out, gets None rather than an empty
+        result, so callers can leave it to be retried instead of storing it.
+        """
+        # Products with identical inputs (e.g. a shared wholesaler blurb) are only sent once
+        unique = {}
+        for item in items:
+            unique.setdefault(self._extraction_cache_key(**item), item)
+        
+        keys = list(unique)
+        results = await asyncio.gather(*(self._request_extraction(**item) for item in unique.values()), return_exceptions=True)
+        by_key = {}
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                print(f"Error extracting coffee data for {unique[key].get('parent_title') or 'Unknown'}: {str(result)}")
+                result = None
+            by_key[key] = result
+        
+        # Give each product its own copy so callers can modify results independently
+        return [copy.deepcopy(by_key[self._extraction_cache_key(**item)]) for item in items]
+
+    def _extraction_cache_key(self, body_html: str = None, tags: List[str] = None, scraped_html: str = None, parent_title: str = None, image_url: str = None) -> str:
+        """Cache key covering every input that can change an extraction result"""
+        return llm_cache.make_key(
+            body=body_html,
+            scraped=scraped_html,
+            tags=tags,
+            title=parent_title,
+            image=image_url
+        )
+
+    async def extract_coffee_data_async(self, body_html: str, tags: List[str] = None, scraped_html: str = None, parent_title: str = None, image_url: str = None) -> Dict:
+        """Extract structured coffee data from product description using Azure OpenAI
+
+        Transient Azure errors are raised once their retries run out; any other failure
+        gets an empty result.
+        """
         try:
-            # Clean and combine text
-            text = []
-            
-            # Add parent title if available
-            if parent_title:
-                text.append("=== PRODUCT TITLE ===")
-                text.append(parent_title)
-            
-            # Add original body_html
-            if body_html:
-                text.append("\n=== SHOPIFY PRODUCT DESCRIPTION ===")
-                text.append(body_html)
-            
-            # Add scraped HTML content if available
-            if scraped_html:
-                text.append("\n=== SCRAPED PRODUCT PAGE CONTENT ===")
-                text.append(self._clean_html(scraped_html))
-            
-            # Add tags
-            if tags:
-                text.append("\n=== PRODUCT TAGS ===")
-                text.append(f"Tags: {', '.join(tags)}")
-            
-            # Create messages list for chat completion
-            messages = []
-            
-            # If we have an image URL, process and add it
-            if image_url:
-                # Downsample image and convert to base64
-                base64_image = self._downsample_image(image_url)
-                
-                if base64_image:
-                    messages.append({
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": base64_image,
-                                    "detail": "low"  # Use low detail since we've already downsampled
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": "Please analyze this coffee product image."
-                            }
-                        ]
-                    })
-                    
-                    # Get image analysis from GPT-4V
-                    image_completion = self.client.chat.completions.create(
-                        model=self.deployment_name,
-                        messages=messages,
-                        temperature=0.0,
-                        max_tokens=500
-                    )
-                    
-                    # Add image analysis to text
-                    text.append("\n=== IMAGE ANALYSIS ===")
-                    text.append(image_completion.choices[0].message.content)
-            
-            # Create final prompt
-            prompt = f"""Extract coffee product details from this text. Pay special attention to the PRODUCT TITLE for determining if this is a blend or single origin coffee, and consider any details found in the IMAGE ANALYSIS if present.
-            Attempt to identify the origin, processing method, varietals, altitude, farm, producer, and tasting notes. 
-            You are provided shop data, a scraped html page, and an analysis of the product image in order to extract this information.
-            Extract information specific to the product, ignoring any superfluous information from the image or shop data.
-            Return a JSON object with these fields:
-            - is_single_origin: true/false/null (if unclear)
-              - true if it's from one specific farm, producer, or region
-              - false if it contains the word "blend" or mentions multiple origins
-              - null if unclear
-            - origin: {{"country": string/null, "region": string/null}}
-            - roast_level: string/null
-            - processing_method: string/null, format Proper case, primary; secondary; other where primary is "Washed", "Natural", "Honey", and secondary/other contain information about fermentation or experimental process elements.
-            - varietals: list of strings, may also be called cultivars
-            - altitude: string/null, format XXXX-YYYY if a range, or XXXX if a single value. Convert to masl if necessary, then remove units.
-            - farm: string/null
-            - producer: string/null, producer refers to the bean producer, not the local roaster.
-            - tasting_notes: {{
-                "fruits": list of strings,
-                "sweets": list of strings,
-                "florals": list of strings,
-                "spices": list of strings,
-                "others": list of strings
-            }}
-            - confidence_score: float (0-1)
-
-            Also estimate a recommended resting period in days based on these guidelines:
-            - Natural/honey process: 10-14 days
-            - Washed process: 7-10 days
-            - Darker/Espresso roasts: Subtract 2-3 days
-            - Lighter/Filter roasts: Add 2-3 days
-            - African varietals (SL28, SL34, Ruiru 11, Batian): Add 1-2 days
-            - Dense beans (high altitude >1600m): Add 1-2 days
-            Return this as resting_period_days in the JSON.
-
-            Text:
-            {'\n'.join(text)}"""
-            
-            # Dump prompt to file
-            self._dump_prompt(prompt, parent_title or "Unknown")
+            return await self._request_extraction(body_html, tags, scraped_html, parent_title, image_url)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            print(f"Error extracting coffee data: {str(e)}")
+            return self._get_empty_result()
 
-            # Get completion from Azure OpenAI
-            completion = self.client.chat.completions.create(
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=60, min=60, max=180), retry=retry_if_exception_type(TRANSIENT_ERRORS), reraise=True)
+    async def _request_extraction(self, body_html: str, tags: List[str] = None, scraped_html: str = None, parent_title: str = None, image_url: str = None) -> Dict:
+        """Extract one product, raising on failure so nothing is cached or stored for it"""
+        await self._bind_event_loop()
+        
+        # Responses are deterministic (temperature 0), so identical inputs can reuse a cached result
+        cache_key = self._extraction_cache_key(body_html, tags, scraped_html, parent_title, image_url)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            print(f"Using cached extraction for: {parent_title or 'Unknown'}")
+            return cached
+
+        content = await self._build_user_content(body_html, tags, scraped_html, parent_title, image_url)
+
+        # Get completion from Azure OpenAI (tenacity retries the transient errors this raises)
+        async with self._sem:
+            await self._throttle()
+            completion = await self.async_client.chat.completions.create(
                 model=self.deployment_name,
-                messages=[{"role": "user", "content": prompt}],
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": content}
+                ],
                 temperature=0.0,
                 response_format={"type": "json_object"}
             )
 
-            # Parse response
-            response = json.loads(completion.choices[0].message.content)
-            
-            # Ensure all fields exist
-            response.setdefault('is_single_origin', None)
-            response.setdefault('origin', {'country': None, 'region': None})
-            response.setdefault('roast_level', None)
-            response.setdefault('processing_method', None)
-            response.setdefault('varietals', [])
-            response.setdefault('altitude', None)
-            response.setdefault('farm', None)
-            response.setdefault('producer', None)
-            response.setdefault('resting_period_days', None)
-            response.setdefault('tasting_notes', {
-                'fruits': [],
-                'sweets': [],
-                'florals': [],
-                'spices': [],
-                'others': []
-            })
-            response.setdefault('confidence_score', 0.0)
-            
-            return response
+        # Parse response
+        response = json_loads(completion.choices[0].message.content)
+        
+        response = self._normalize_result(response)
+        
+        llm_cache.set(cache_key, response, self.cache_ttl_days)
+        return response
 
-        except Exception as e:
-            print(f"Error extracting coffee data: {str(e)}")
-            return self._get_empty_result()
+    async def _build_user_content(self, body_html: str, tags: List[str] = None, scraped_html: str = None, parent_title: str = None, image_url: str = None) -> List[Dict]:
+        """Build the user message content for one product, with its downsampled image if available"""
+        # Clean and combine text (HTML parsing is CPU-bound, so run it in a worker thread)
+        text = await asyncio.to_thread(self._build_product_text, body_html, tags, scraped_html, parent_title)
+        
+        # Only the product text varies between calls
+        content = [{"type": "text", "text": '\n'.join(text)}]
+        
+        # If we have an image URL, downsample it and send it alongside the text
+        if image_url:
+            base64_image = await self._downsample_image(image_url)
+            if base64_image:
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": base64_image,
+                        "detail": "low"  # Use low detail since we've already downsampled
+                    }
+                })
+        
+        # Dump prompt to file
+        self._dump_prompt(f"{SYSTEM_PROMPT}\nText:\n{content[0]['text']}", parent_title or "Unknown")
+        return content
+
+    async def _build_user_contents(self, items: List[Dict]) -> List:
+        """Build the user message content for several products concurrently"""
+        await self._bind_event_loop()
+        return await asyncio.gather(*(self._build_user_content(**item) for item in items), return_exceptions=True)
+
+    def open_offline_batch(self) -> 'OfflineBatch':
+        """Start an Azure OpenAI Batch API job that products are added to a window at a time
+
+        The batch is billed at a discount but can take up to 24 hours, so submit() blocks
+        until it finishes.
+        """
+        return OfflineBatch(self)
+
+    def _batch_request(self, custom_id: str, content: List[Dict]) -> Dict:
+        """Build one line of a Batch API input file"""
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": self.deployment_name,
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": content}
+                ],
+                "temperature": 0.0,
+                "response_format": {"type": "json_object"}
+            }
+        }
+
+    def _run_offline_batch(self, input_path: str, count: int) -> List[str]:
+        """Upload a Batch API input file, wait for the job and return its output lines"""
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/chat/completions", completion_window="24h")
+        print(f"Submitted batch {batch.id} for {count} products")
+        
+        # Poll with exponential backoff until the batch reaches a final state
+        delay = BATCH_POLL_SECONDS
+        while batch.status not in BATCH_FINAL_STATUSES:
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+            batch = self.client.batches.retrieve(batch.id)
+            print(f"Batch {batch.id} is {batch.status}")
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"Batch {batch.id} finished as {batch.status} without results")
+            return []
+        return self.client.files.content(batch.output_file_id).text.splitlines()
+
+class OfflineBatch:
+    """A Batch API job whose input file is written as products are added
+
+    Each window's requests go to disk as soon as they're built, and only the products'
+    cache keys are kept, so memory holds one window however many products the job covers.
+    """
+    def __init__(self, extractor: AICoffeeExtractor):
+        self.extractor = extractor
+        # Cache key of every product added, in order
+        self.keys = []
+        # Results already in the cache, by key
+        self.cached = {}
+        # Key of each request in the input file, indexed by its custom_id, and the product titles for errors
+        self.sent = []
+        self.titles = {}
+        fd, self.input_path = tempfile.mkstemp(suffix='.jsonl')
+        self.input_file = os.fdopen(fd, 'w', encoding='utf-8')
+
+    def add(self, items: List[Dict]):
+        """Add products, taking the same items as extract_coffee_data_many_async"""
+        # Serve what we can from the cache; products with identical inputs are only sent once
+        unique = {}
+        for item in items:
+            key = self.extractor._extraction_cache_key(**item)
+            self.keys.append(key)
+            if key in self.cached or key in self.titles or key in unique:
+                continue
+            cached = llm_cache.get(key)
+            if cached is not None:
+                self.cached[key] = cached
+            else:
+                unique[key] = item
+        
+        contents = self.extractor.run(self.extractor._build_user_contents(list(unique.values())))
+        for (key, item), content in zip(unique.items(), contents):
+            title = item.get('parent_title') or 'Unknown'
+            if isinstance(content, Exception):
+                print(f"Error preparing {title} for batch extraction: {str(content)}")
+                continue
+            self.input_file.write(json.dumps(self.extractor._batch_request(str(len(self.sent)), content)) + '\n')
+            self.sent.append(key)
+            self.titles[key] = title
+
+    def submit(self) -> List[Optional[Dict]]:
+        """Run the job and return a result for every product added, in order
+
+        Products the batch returned no result for, including every product of a job that
+        failed, expired or was cancelled, get None so callers can retry them later.
+        """
+        self.input_file.close()
+        try:
+            lines = self.extractor._run_offline_batch(self.input_path, len(self.sent)) if self.sent else []
+        finally:
+            self.close()
+        
+        results = dict(self.cached)
+        for line in lines:
+            if not line:
+                continue
+            record = json_loads(line)
+            key = self.sent[int(record['custom_id'])]
+            try:
+                body = record['response']['body']
+                result = self.extractor._normalize_result(json_loads(body['choices'][0]['message']['content']))
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                print(f"Error extracting coffee data for {self.titles[key]}: {str(e)}")
+                continue
+            llm_cache.set(key, result, self.extractor.cache_ttl_days)
+            results[key] = result
+        
+        # Give each product its own copy so callers can modify results independently
+        return [copy.deepcopy(results.get(key)) for key in self.keys]
+
+    def close(self):
+        """Discard the input file; safe to call more than once"""
+        self.input_file.close()
+        if os.path.exists(self.input_path):
+            os.remove(self.input_path)
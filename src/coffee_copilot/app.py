@@ -1,18 +1,127 @@
 from shopify_scraper import scraper
-from coffee_copilot.database import init_db, get_session, Roaster, Product, ProductOption, ProductImage, Variant
+from coffee_copilot.database import init_db, get_session, refresh_whole_beans_mat, bulk_insert_variants, engine, Roaster, Product, ProductOption, ProductImage, HttpCache
 from coffee_copilot.config import ROASTER_URLS, config
-from datetime import datetime
 import pandas as pd
+import requests
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import insert
+import json
+import types
+
+# The scraper parses each products.json page with its module-level json; give it orjson's loads when available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+if orjson is not None and isinstance(getattr(scraper, 'json', None), types.ModuleType):
+    scraper_json = types.ModuleType('json')
+    scraper_json.__dict__.update(json.__dict__)
+    scraper_json.loads = orjson.loads
+    scraper.json = scraper_json
+
+# Roasters whose catalog answers a conditional request with 304 Not Modified aren't scraped again
+scraping_config = config.get('scraping', {})
+conditional_scrape_enabled = scraping_config.get('conditional_scrape_enabled', True)
+catalog_timeout = (scraping_config.get('connect_timeout_seconds', 3), scraping_config.get('read_timeout_seconds', 10))
+
+# Products per catalog page, as requested from products.json
+CATALOG_PAGE_SIZE = 250
+
+# Roasters are on independent hosts, so this many are fetched at once
+SCRAPE_WORKERS = 8
+
+# Numeric variant columns cast once per frame in store_data, as (column, default for missing values, type)
+VARIANT_NUMERIC_COLUMNS = (
+    ('available', 0, int),
+    ('grams', 0, int),
+    ('position', 0, int),
+    ('requires_shipping', 1, int),
+    ('taxable', 1, int),
+    ('price', 0.0, float),
+)
+
+def catalog_url(roaster_url):
+    """URL of the roaster's first products.json page"""
+    return f"{roaster_url.rstrip('/')}/products.json?limit={CATALOG_PAGE_SIZE}&page=1"
+
+def fits_first_page(response):
+    """Whether a catalog page response holds the roaster's whole catalog (fewer than a full page of products)"""
+    try:
+        products = (orjson.loads if orjson else json.loads)(response.content).get('products')
+    except (ValueError, AttributeError):
+        return False
+    return isinstance(products, list) and len(products) < CATALOG_PAGE_SIZE
+
+def check_catalog(roaster_url, cached):
+    """Conditionally request the roaster's first catalog page using the cached validators
+
+    Returns None if it is unchanged since the last stored scrape, otherwise an HttpCache row
+    holding its new validators, to be merged once the scrape has been stored. Only the first
+    page is validated, so validators are only kept for catalogs that fit on it.
+    """
+    url = catalog_url(roaster_url)
+    headers = {}
+    if cached and cached.etag:
+        headers['If-None-Match'] = cached.etag
+    if cached and cached.last_modified:
+        headers['If-Modified-Since'] = cached.last_modified
+
+    try:
+        response = requests.get(url, headers=headers, timeout=catalog_timeout)
+    except requests.RequestException:
+        # Let the scraper try (and report) the roaster as usual
+        return HttpCache(url=url)
+    if response.status_code == 304:
+        return None
+    # A longer catalog can change on a later page while the first is unchanged, so always scrape it
+    if not response.ok or not fits_first_page(response):
+        return HttpCache(url=url)
+    return HttpCache(
+        url=url,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified')
+    )
+
+def parse_timestamp(value):
+    """Parse a Shopify ISO 8601 timestamp, or return None if it's missing"""
+    if isinstance(value, str) and value:
+        # fromisoformat only accepts a Z suffix from Python 3.11
+        return datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if isinstance(value, datetime):
+        return value
+    return None
+
+def content_hash(title, body_html, tags):
+    """Short hash of the catalog fields the AI extraction reads, so unchanged products can reuse their details"""
+    content = '\0'.join(part if isinstance(part, str) else '' for part in (title, body_html, tags))
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=8).hexdigest()
 
-def store_data(roaster_name, roaster_url, products_df, variants_df, session):
-    """Store roaster, products, options, and images in the database"""
+def fetch_roaster(roaster_url, cached):
+    """Fetch a roaster's products and variants (runs on a worker thread, without touching the database)
+
+    Returns None if the catalog is unchanged, otherwise (catalog, products, variants).
+    """
+    catalog = check_catalog(roaster_url, cached) if conditional_scrape_enabled else None
+    if conditional_scrape_enabled and catalog is None:
+        return None
+
+    products = scraper.get_products(roaster_url)
+    variants = scraper.get_variants(products) if not products.empty else None
+    return catalog, products, variants
+
+def store_data(roaster_name, roaster_url, products_df, variants_df, session, roaster=None):
+    """Store roaster, products, options, and images in the database
+
+    roaster is the already stored Roaster for roaster_url, or None to create it.
+    """
     
     # Get roaster description from config
     roaster_description = next((data['description'] for name, data in config['roasters'].items() 
                               if data['name'] == roaster_name), roaster_name.title())
     
-    # Create or get roaster
-    roaster = session.query(Roaster).filter_by(url=roaster_url).first()
+    # Create or update roaster
     if not roaster:
         roaster = Roaster(name=roaster_name, description=roaster_description, url=roaster_url)
         session.add(roaster)
@@ -21,100 +130,156 @@ def store_data(roaster_name, roaster_url, products_df, variants_df, session):
         roaster.description = roaster_description  # Update description in case it changed
         session.flush()
 
-    # Store products
-    for _, row in products_df.iterrows():
-        product = Product(
-            roaster_id=roaster.id,
-            title=row['title'],
-            handle=row.get('handle', ''),
-            body_html=row.get('body_html', ''),
-            published_at=pd.to_datetime(row.get('published_at')),
-            created_at=pd.to_datetime(row.get('created_at')),
-            updated_at=pd.to_datetime(row.get('updated_at')),
-            vendor=row.get('vendor', ''),
-            product_type=row.get('product_type', ''),
-            tags=','.join(row['tags']) if isinstance(row.get('tags'), list) else row.get('tags', ''),
-            url=row['url'],
-            last_updated=datetime.now()
-        )
-        session.add(product)
-        session.flush()
+    # Products, options, images and variants are each written in one bulk insert, skipping the ORM unit of work
+    # Plain dicts of native values are much cheaper to walk than iterrows() Series
+    product_records = products_df.to_dict('records')
+    if not product_records:
+        return
+    product_rows = [dict(
+        roaster_id=roaster.id,
+        title=row['title'],
+        handle=row.get('handle', ''),
+        body_html=row.get('body_html', ''),
+        published_at=parse_timestamp(row.get('published_at')),
+        created_at=parse_timestamp(row.get('created_at')),
+        updated_at=parse_timestamp(row.get('updated_at')),
+        vendor=row.get('vendor', ''),
+        product_type=row.get('product_type', ''),
+        tags=','.join(row['tags']) if isinstance(row.get('tags'), list) else row.get('tags', ''),
+        url=row['url']
+    ) for row in product_records]
+    for product_row in product_rows:
+        product_row['content_hash'] = content_hash(product_row['title'], product_row['body_html'], product_row['tags'])
+    product_ids = session.execute(
+        insert(Product).returning(Product.id, sort_by_parameter_order=True),
+        product_rows
+    ).scalars().all()
+
+    option_rows = []
+    image_rows = []
+    variant_rows = []
 
+    # Cast the numeric columns once for the whole frame rather than per variant
+    variants_df = variants_df.assign(**{
+        name: pd.to_numeric(variants_df[name], errors='coerce').fillna(default).astype(dtype) if name in variants_df else default
+        for name, default, dtype in VARIANT_NUMERIC_COLUMNS
+    })
+    # compare_at_price is nullable, so missing values become None rather than a default
+    if 'compare_at_price' in variants_df:
+        compare_at_prices = pd.to_numeric(variants_df['compare_at_price'], errors='coerce')
+        variants_df['compare_at_price'] = compare_at_prices.astype(object).where(compare_at_prices.notna(), None)
+    else:
+        variants_df['compare_at_price'] = None
+
+    # Group the variants by product once rather than filtering the whole frame per product
+    variants_by_parent = {parent_id: group.to_dict('records') for parent_id, group in variants_df.groupby('parent_id', sort=False)}
+
+    for product_id, row in zip(product_ids, product_records):
         # Store options
         if 'options' in row and isinstance(row['options'], list):
             for option in row['options']:
-                opt = ProductOption(
-                    product_id=product.id,
+                option_rows.append(dict(
+                    product_id=product_id,
                     name=option.get('name', ''),
                     values=','.join(option['values']) if isinstance(option.get('values'), list) else str(option.get('values', ''))
-                )
-                session.add(opt)
+                ))
 
         # Store images
         if 'images' in row and isinstance(row['images'], list):
             for idx, image in enumerate(row['images']):
-                img = ProductImage(
-                    product_id=product.id,
+                image_rows.append(dict(
+                    product_id=product_id,
                     src=image.get('src', ''),
                     position=idx + 1
-                )
-                session.add(img)
+                ))
 
         # Store variants for this product
-        product_variants = variants_df[variants_df['parent_id'] == row['id']]
-        for _, variant in product_variants.iterrows():
-            v = Variant(
-                product_id=product.id,
+        for variant in variants_by_parent.get(row['id'], []):
+            variant_rows.append(dict(
+                product_id=product_id,
                 title=variant['title'],
-                available=int(variant.get('available', 0)),
-                compare_at_price=float(variant['compare_at_price']) if pd.notna(variant.get('compare_at_price')) else None,
-                created_at=pd.to_datetime(variant.get('created_at')),
+                available=variant['available'],
+                compare_at_price=variant['compare_at_price'],
+                created_at=parse_timestamp(variant.get('created_at')),
                 featured_image=variant.get('featured_image', ''),
-                grams=int(variant.get('grams', 0)),
+                grams=variant['grams'],
                 option1=variant.get('option1', ''),
                 option2=variant.get('option2', ''),
                 option3=variant.get('option3', ''),
-                position=int(variant.get('position', 0)),
-                price=float(variant['price']) if pd.notna(variant.get('price')) else 0.0,
-                requires_shipping=int(variant.get('requires_shipping', 1)),
+                position=variant['position'],
+                price=variant['price'],
+                requires_shipping=variant['requires_shipping'],
                 sku=variant.get('sku', ''),
-                taxable=int(variant.get('taxable', 1)),
-                updated_at=pd.to_datetime(variant.get('updated_at')),
+                taxable=variant['taxable'],
+                updated_at=parse_timestamp(variant.get('updated_at')),
                 parent_title=variant.get('parent_title', ''),
                 vendor=variant.get('vendor', ''),
+                roaster_name=roaster.name,
+                product_url=row['url'],
                 weight=variant.get('weight'),
                 weight_unit=variant.get('weight_unit'),
                 barcode=variant.get('barcode'),
-                inventory_quantity=variant.get('inventory_quantity', 0),
-                last_updated=datetime.now()
-            )
-            session.add(v)
+                inventory_quantity=variant.get('inventory_quantity', 0)
+            ))
+
+    if option_rows:
+        session.execute(insert(ProductOption), option_rows)
+    if image_rows:
+        session.execute(insert(ProductImage), image_rows)
+    bulk_insert_variants(session, variant_rows)
 
 def main():
     # Initialize database
     init_db()
     session = get_session()
 
-    # Scrape each roaster
-    for roaster_name, url in ROASTER_URLS.items():
-        print(f"Scraping {roaster_name} at {url}")
-        try:
-            # Get products and variants
-            products = scraper.get_products(url)
-            if not products.empty:
-                variants = scraper.get_variants(products)
-                
-                # Store in database
-                store_data(roaster_name, url, products, variants, session)
-                print(f"Stored {len(products)} products and {len(variants)} variants for {roaster_name}")
-            else:
-                print(f"No products found for {roaster_name}")
-        except Exception as e:
-            print(f"Error scraping {roaster_name}: {str(e)}")
-            continue
+    # Stored roasters and cached validators are each read in one query
+    roaster_urls = list(ROASTER_URLS.values())
+    roasters = {roaster.url: roaster for roaster in session.query(Roaster).filter(Roaster.url.in_(roaster_urls))}
+    cached_catalogs = {
+        catalog.url: catalog
+        for catalog in session.query(HttpCache).filter(HttpCache.url.in_([catalog_url(url) for url in roaster_urls]))
+    }
+    # The worker threads read the validators without the session, so detach them before commits expire them
+    for catalog in cached_catalogs.values():
+        session.expunge(catalog)
+
+    # Fetch the roasters concurrently, storing each on this thread as its fetch completes
+    with ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as executor:
+        fetches = {}
+        for roaster_name, url in ROASTER_URLS.items():
+            print(f"Scraping {roaster_name} at {url}")
+            fetches[executor.submit(fetch_roaster, url, cached_catalogs.get(catalog_url(url)))] = (roaster_name, url)
+
+        for fetch in as_completed(fetches):
+            roaster_name, url = fetches[fetch]
+            try:
+                result = fetch.result()
+                if result is None:
+                    print(f"Catalog unchanged for {roaster_name}, keeping stored products")
+                    continue
+
+                catalog, products, variants = result
+                if not products.empty:
+                    # Store in database
+                    store_data(roaster_name, url, products, variants, session, roasters.get(url))
+                    # Only remember the catalog's validators once its products are stored
+                    if catalog is not None:
+                        session.merge(catalog)
+                    # Commit each roaster so enhancement running alongside can pick its products up
+                    session.commit()
+                    print(f"Stored {len(products)} products and {len(variants)} variants for {roaster_name}")
+                else:
+                    print(f"No products found for {roaster_name}")
+            except Exception as e:
+                # Don't let a half-stored roaster be committed with the next one
+                session.rollback()
+                print(f"Error scraping {roaster_name}: {str(e)}")
+                continue
 
     # Commit all changes
     session.commit()
+    refresh_whole_beans_mat(engine)
     print("All data has been stored in the database")
 
 if __name__ == "__main__":
@@ -1,8 +1,14 @@
+from functools import lru_cache
 import yaml
 
+@lru_cache(maxsize=1)
+def get_config():
+    """Load config.yaml once and share it across modules"""
+    with open('config.yaml', 'r') as f:
+        return yaml.safe_load(f)
+
 # Load config
-with open('config.yaml', 'r') as f:
-    config = yaml.safe_load(f)
+config = get_config()
 
 # Get roaster URLs
 ROASTER_URLS = {name: data['url'] for name, data in config['roasters'].items()}
@@ -1,17 +1,48 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, JSON, Table, text, Boolean, inspect
+from sqlalchemy import create_engine, event, Column, Computed, Integer, String, Float, DateTime, ForeignKey, Index, JSON, Table, text, bindparam, Boolean, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.sql import func, table, column
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import sessionmaker, relationship, joinedload, raiseload
+from contextlib import contextmanager
+import hashlib
 import os
 
 # Create data directory if it doesn't exist
 data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data')
 os.makedirs(data_dir, exist_ok=True)
 
+# Connections kept open for the pipeline's scraper and enhancer threads
+DB_POOL_SIZE = int(os.environ.get('COFFEE_DB_POOL_SIZE', 8))
+
 # Create engine with SQLite's native Unicode support
-engine = create_engine(f'sqlite:///{os.path.join(data_dir, "coffee_data.db")}', connect_args={'check_same_thread': False})
+engine = create_engine(
+    f'sqlite:///{os.path.join(data_dir, "coffee_data.db")}',
+    connect_args={'check_same_thread': False},
+    query_cache_size=1200,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=8
+)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    """Use WAL so readers don't block the scrape writer, and give SQLite more cache"""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 Base = declarative_base()
 
+def local_now():
+    """SQL expression for the current local time, so SQLite stamps rows instead of Python"""
+    return func.strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
+
+# Session factory shared by every get_session() call
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
 class Roaster(Base):
     __tablename__ = 'roasters'
     
@@ -19,16 +50,20 @@ class Roaster(Base):
     name = Column(String(100))
     description = Column(String(200))  # Friendly name for display
     url = Column(String(500))
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    created_at = Column(DateTime, default=local_now())
+    updated_at = Column(DateTime, default=local_now(), onupdate=local_now())
     
     products = relationship("Product", back_populates="roaster")
 
 class Product(Base):
     __tablename__ = 'products'
+    __table_args__ = (
+        # Finds earlier rows of a re-scraped product whose content hasn't changed
+        Index('ix_products_url_hash', 'url', 'content_hash'),
+    )
     
     id = Column(Integer, primary_key=True)
-    roaster_id = Column(Integer, ForeignKey('roasters.id'))
+    roaster_id = Column(Integer, ForeignKey('roasters.id'), index=True)
     title = Column(String(200))
     handle = Column(String(200))
     body_html = Column(String)  # SQLite handles Unicode natively
@@ -40,31 +75,53 @@ class Product(Base):
     tags = Column(String)
     url = Column(String(500))
     parent_title = Column(String(200))
-    last_updated = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    content_hash = Column(String(16))  # Hash of the catalog fields the AI extraction reads
+    last_updated = Column(DateTime, default=local_now(), onupdate=local_now())
     
-    # Relationships
-    roaster = relationship("Roaster", back_populates="products")
+    # Relationships (roaster and extended details are loaded in the same query; collections stay lazy)
+    roaster = relationship("Roaster", back_populates="products", lazy="joined")
     options = relationship("ProductOption", back_populates="product", cascade="all, delete-orphan")
     variants = relationship("Variant", back_populates="product", cascade="all, delete-orphan")
     images = relationship("ProductImage", back_populates="product", cascade="all, delete-orphan")
-    extended_details = relationship("ProductExtendedDetails", back_populates="product", uselist=False, cascade="all, delete-orphan")
+    extended_details = relationship("ProductExtendedDetails", back_populates="product", uselist=False, lazy="joined", cascade="all, delete-orphan")
 
 class ProductOption(Base):
     __tablename__ = 'product_options'
     
     id = Column(Integer, primary_key=True)
-    product_id = Column(Integer, ForeignKey('products.id'))
+    product_id = Column(Integer, ForeignKey('products.id'), index=True)
     name = Column(String(100))
     position = Column(Integer)
     values = Column(JSON)
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    created_at = Column(DateTime, default=local_now())
+    updated_at = Column(DateTime, default=local_now(), onupdate=local_now())
     
     # Relationships
     product = relationship("Product", back_populates="options")
 
+# Whole bean, retail-size variants that aren't espresso, subscriptions, decaf, vouchers, wholesale or RTD
+BEAN_ELIGIBLE_SQL = (
+    "option2_lc LIKE '%bean%'"
+    " AND (option1 LIKE '%250%' OR option1 LIKE '%200g%')"
+    " AND parent_title_lc NOT LIKE '%espresso%'"
+    " AND parent_title_lc NOT LIKE '%subscription%'"
+    " AND parent_title_lc NOT LIKE '%decaf%'"
+    " AND parent_title_lc NOT LIKE '%voucher%'"
+    " AND vendor != 'AAZ B2B'"
+    " AND (option3 != 'READY TO DRINK' OR option3 IS NULL)"
+)
+
 class Variant(Base):
     __tablename__ = 'variants'
+    __table_args__ = (
+        # Also serves product_id lookups and joins
+        Index('ix_variants_product_grams', 'product_id', 'grams'),
+        Index('ix_variants_ptg', 'parent_title', 'grams'),
+        Index('ix_variants_flags', 'option2_lc', 'parent_title_lc', 'grams', 'vendor'),
+        # Partial index over just the available whole bean variants the beans view scans
+        Index('ix_variants_bean_eligible', 'parent_title', 'roaster_name', 'grams',
+              sqlite_where=text("available = 1 AND bean_eligible = 1")),
+    )
     
     id = Column(Integer, primary_key=True)
     product_id = Column(Integer, ForeignKey('products.id'))
@@ -83,13 +140,22 @@ class Variant(Base):
     taxable = Column(Integer, default=1)
     parent_title = Column(String(200))
     vendor = Column(String(200))
+    roaster_name = Column(String(100))  # Copied from the roaster at ingest so the beans view reads one table
+    product_url = Column(String(500))  # Copied from the product at ingest
     weight = Column(Float)
     weight_unit = Column(String(10))
     barcode = Column(String(100))
     inventory_quantity = Column(Integer)
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
-    last_updated = Column(DateTime, default=datetime.now)
+    created_at = Column(DateTime, default=local_now())
+    updated_at = Column(DateTime, default=local_now(), onupdate=local_now())
+    last_updated = Column(DateTime, default=local_now())
+    
+    # Lowercased copies for the whole beans filters, computed by SQLite
+    option2_lc = Column(String(100), Computed("lower(option2)"))
+    parent_title_lc = Column(String(200), Computed("lower(parent_title)"))
+    
+    # 1 when the variant passes the beans view's fixed filters, so the substring matches run on write, not per query
+    bean_eligible = Column(Integer, Computed(BEAN_ELIGIBLE_SQL))
     
     # Relationships
     product = relationship("Product", back_populates="variants")
@@ -98,14 +164,14 @@ class ProductImage(Base):
     __tablename__ = 'product_images'
     
     id = Column(Integer, primary_key=True)
-    product_id = Column(Integer, ForeignKey('products.id'))
+    product_id = Column(Integer, ForeignKey('products.id'), index=True)
     position = Column(Integer)
     src = Column(String(500))
     width = Column(Integer)
     height = Column(Integer)
     alt = Column(String(200))
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    created_at = Column(DateTime, default=local_now())
+    updated_at = Column(DateTime, default=local_now(), onupdate=local_now())
     
     # Relationships
     product = relationship("Product", back_populates="images")
@@ -127,21 +193,32 @@ class ProductExtendedDetails(Base):
     tasting_notes = Column(JSON)
     resting_period_days = Column(Integer)
     extraction_confidence = Column(Float)
-    last_updated = Column(DateTime, default=datetime.now)
+    last_updated = Column(DateTime, default=local_now())
+    
+    # Each tasting note category as its own JSON array, extracted by SQLite so it can be indexed
+    tasting_fruits = Column(String, Computed("json_extract(tasting_notes, '$.fruits')"), index=True)
+    tasting_sweets = Column(String, Computed("json_extract(tasting_notes, '$.sweets')"), index=True)
+    tasting_florals = Column(String, Computed("json_extract(tasting_notes, '$.florals')"), index=True)
+    tasting_spices = Column(String, Computed("json_extract(tasting_notes, '$.spices')"), index=True)
+    tasting_others = Column(String, Computed("json_extract(tasting_notes, '$.others')"), index=True)
     
     # Relationships
     product = relationship("Product", back_populates="extended_details")
 
 class OrderHistory(Base):
     __tablename__ = 'order_history'
+    __table_args__ = (
+        # Serves the available options anti-join and product_id lookups
+        Index('ix_order_history_pv', 'product_id', 'variant_id'),
+    )
     
     id = Column(Integer, primary_key=True)
     # Reference to the original product and variant
     product_id = Column(Integer, ForeignKey('products.id'))  # Can be null if product is deleted
-    variant_id = Column(Integer, ForeignKey('variants.id'))  # Can be null if variant is deleted
+    variant_id = Column(Integer, ForeignKey('variants.id'), index=True)  # Can be null if variant is deleted
     
     # Order details
-    order_date = Column(DateTime, default=datetime.now)
+    order_date = Column(DateTime, default=local_now(), index=True)
     quantity = Column(Integer, nullable=False)
     price_paid = Column(Float, nullable=False)
     notes = Column(String)  # For any personal notes about the order
@@ -166,15 +243,98 @@ class OrderHistory(Base):
     producer = Column(String(200))
     tasting_notes = Column(JSON)
     
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    created_at = Column(DateTime, default=local_now())
+    updated_at = Column(DateTime, default=local_now(), onupdate=local_now())
     
     # Relationships
-    product = relationship("Product")
-    variant = relationship("Variant")
+    product = relationship("Product", lazy="joined")
+    variant = relationship("Variant", lazy="joined")
+
+class HttpCache(Base):
+    __tablename__ = 'http_cache'
+    
+    url = Column(String(500), primary_key=True)
+    # Validators from the last successfully stored response, sent back as If-None-Match / If-Modified-Since
+    etag = Column(String(200))
+    last_modified = Column(String(100))
+    fetched_at = Column(DateTime, default=local_now(), onupdate=local_now())
+
+class SchemaMeta(Base):
+    __tablename__ = 'schema_meta'
+    
+    key = Column(String(100), primary_key=True)  # e.g. "view:whole_beans_view"
+    value = Column(String(100))  # SHA-256 of the definition last applied
+
+# Lightweight handle on the materialized beans table for Core selects (it isn't an ORM model)
+whole_beans_mat = table(
+    'whole_beans_mat',
+    column('product_id'),
+    column('variant_id'),
+    column('parent_title'),
+    column('roaster_name'),
+    column('price')
+)
+
+# Trigram full-text index over whole_beans_mat titles, keyed by product_id, so LIKE '%name%'
+# searches use the index instead of scanning the table
+whole_beans_search = table(
+    'whole_beans_search',
+    column('rowid'),
+    column('parent_title')
+)
+
+WHOLE_BEANS_SEARCH_CREATE_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS whole_beans_search USING fts5(
+    parent_title, content='whole_beans_mat', content_rowid='product_id', tokenize='trigram'
+)
+"""
+
+# Re-reads the titles from whole_beans_mat; run in the same transaction as any change to it
+WHOLE_BEANS_SEARCH_REBUILD_SQL = "INSERT INTO whole_beans_search(whole_beans_search) VALUES('rebuild')"
+
+# Counts whole_beans_mat refreshes, so caches built from it can tell when it has changed
+WHOLE_BEANS_GENERATION_KEY = 'generation:whole_beans_mat'
+WHOLE_BEANS_GENERATION_SQL = f"""
+INSERT INTO schema_meta (key, value) VALUES ('{WHOLE_BEANS_GENERATION_KEY}', '1')
+ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+"""
+
+# Bump whenever init_db's table migrations or indexes change (views track their own definitions)
+SCHEMA_VERSION = 9
+
+TASTING_NOTE_CATEGORIES = ('fruits', 'sweets', 'florals', 'spices', 'others')
 
 def init_db():
     """Initialize the database, creating all tables"""
+    # Skip schema introspection once the tables are current
+    with engine.connect() as conn:
+        schema_current = conn.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION
+    if not schema_current:
+        migrate_schema(engine)
+    
+    # Views are only recreated when their definitions change
+    beans_view_changed = create_beans_view(engine)
+    order_view_changed = create_order_history_view(engine)
+    create_available_options_view(engine)
+    
+    # The materialized tables are otherwise rebuilt after each scrape (and order history on each new order).
+    # order_history_view selects oh.*, so a table migration can change its columns too
+    inspector = inspect(engine)
+    if beans_view_changed or not inspector.has_table('whole_beans_mat') or not inspector.has_table('whole_beans_search'):
+        refresh_whole_beans_mat(engine)
+    elif order_view_changed or not schema_current or not inspector.has_table('order_history_mat'):
+        refresh_order_history_mat(engine)
+    
+    warm_pool(engine)
+
+def warm_pool(engine):
+    """Open the pool's connections up front so later sessions skip the connect pragmas"""
+    conns = [engine.connect() for _ in range(engine.pool.size())]
+    for conn in conns:
+        conn.close()
+
+def migrate_schema(engine):
+    """Bring the tables and indexes up to SCHEMA_VERSION"""
     inspector = inspect(engine)
     
     # Get existing tables
@@ -189,157 +349,401 @@ def init_db():
                 conn.execute(text("ALTER TABLE roasters ADD COLUMN description VARCHAR(200)"))
                 conn.commit()
     
+    if 'products' in existing_tables:
+        with engine.connect() as conn:
+            columns = [col['name'] for col in inspector.get_columns('products')]
+            if 'content_hash' not in columns:
+                conn.execute(text("ALTER TABLE products ADD COLUMN content_hash VARCHAR(16)"))
+                conn.commit()
+    
+    if 'variants' in existing_tables:
+        with engine.connect() as conn:
+            # Generated columns can only be added as VIRTUAL to an existing table
+            columns = [col['name'] for col in inspector.get_columns('variants')]
+            if 'option2_lc' not in columns:
+                conn.execute(text("ALTER TABLE variants ADD COLUMN option2_lc VARCHAR(100) GENERATED ALWAYS AS (lower(option2)) VIRTUAL"))
+            if 'parent_title_lc' not in columns:
+                conn.execute(text("ALTER TABLE variants ADD COLUMN parent_title_lc VARCHAR(200) GENERATED ALWAYS AS (lower(parent_title)) VIRTUAL"))
+            if 'bean_eligible' not in columns:
+                conn.execute(text(f"ALTER TABLE variants ADD COLUMN bean_eligible INTEGER GENERATED ALWAYS AS ({BEAN_ELIGIBLE_SQL}) VIRTUAL"))
+            # Replaced by ix_variants_bean_eligible
+            conn.execute(text("DROP INDEX IF EXISTS ix_variants_available_bean"))
+            if 'roaster_name' not in columns:
+                conn.execute(text("ALTER TABLE variants ADD COLUMN roaster_name VARCHAR(100)"))
+                conn.execute(text("ALTER TABLE variants ADD COLUMN product_url VARCHAR(500)"))
+                # Backfill the copied fields for variants scraped before they existed
+                conn.execute(text("""
+                    UPDATE variants SET
+                        roaster_name = (SELECT r.name FROM products p JOIN roasters r ON p.roaster_id = r.id WHERE p.id = variants.product_id),
+                        product_url = (SELECT p.url FROM products p WHERE p.id = variants.product_id)
+                """))
+            conn.commit()
+    
+    if 'product_extended_details' in existing_tables:
+        with engine.connect() as conn:
+            columns = [col['name'] for col in inspector.get_columns('product_extended_details')]
+            for category in TASTING_NOTE_CATEGORIES:
+                if f'tasting_{category}' not in columns:
+                    conn.execute(text(f"ALTER TABLE product_extended_details ADD COLUMN tasting_{category} VARCHAR GENERATED ALWAYS AS (json_extract(tasting_notes, '$.{category}')) VIRTUAL"))
+            conn.commit()
+    
+    # Validators stored before version 9 could cover multi-page catalogs, which mustn't be skipped on a 304
+    if 'http_cache' in existing_tables:
+        with engine.connect() as conn:
+            if conn.exec_driver_sql("PRAGMA user_version").scalar() < 9:
+                conn.execute(text("DELETE FROM http_cache"))
+                conn.commit()
+    
     # Create or update all tables
     Base.metadata.create_all(engine)
+    create_indexes(engine)
     
-    # Create or update views
-    create_beans_view(engine)
-    create_order_history_view(engine)
-    create_available_options_view(engine)
+    with engine.connect() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+def create_indexes(engine):
+    """Create any model indexes missing from existing tables (create_all only adds them for new tables)"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
-def create_beans_view(engine):
-    """Create a view for whole bean products"""
-    drop_sql = "DROP VIEW IF EXISTS whole_beans_view"
+def replace_view(engine, name: str, view_sql: str) -> bool:
+    """(Re)create a view only if its definition differs from the one last stored in schema_meta"""
+    digest = hashlib.sha256(view_sql.encode('utf-8')).hexdigest()
+    key = f"view:{name}"
+    with engine.connect() as conn:
+        stored = conn.execute(text("SELECT value FROM schema_meta WHERE key = :key"), {"key": key}).scalar()
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = :name"), {"name": name}).scalar()
+        if stored == digest and exists:
+            return False
+        
+        conn.execute(text(f"DROP VIEW IF EXISTS {name}"))
+        conn.execute(text(view_sql))
+        conn.execute(text("""
+            INSERT INTO schema_meta (key, value) VALUES (:key, :value)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """), {"key": key, "value": digest})
+        conn.commit()
+    return True
+
+def create_beans_view(engine) -> bool:
+    """Create a view for whole bean products, returning True if it was (re)created"""
     view_sql = """
     CREATE VIEW whole_beans_view AS
-    WITH ranked_variants AS (
+    WITH eligible_variants AS (
         SELECT 
+            v.id,
             v.parent_title,
-            r.name as roaster_name,
-            v.price,
-            v.option1,
-            v.option2,
-            v.option3,
-            v.available,
-            p.url as product_url,
-            p.id as product_id,
-            v.id as variant_id,
-            CASE 
-                WHEN LOWER(v.parent_title) LIKE '%blend%' THEN 'Blend'
-                WHEN ed.is_single_origin = 1 THEN 'Single Origin'
-                WHEN ed.is_single_origin = 0 THEN 'Blend'
-                WHEN LOWER(v.parent_title) LIKE '% and %' OR LOWER(v.parent_title) LIKE '% & %' THEN 'Blend'
-                ELSE 'Unknown'
-            END as coffee_type,
-            ed.origin_country,
-            ed.origin_region,
-            ed.processing_method,
-            ed.roast_level,
-            ed.varietals,
-            ed.altitude,
-            ed.farm,
-            ed.producer,
-            ed.tasting_notes,
-            ed.extraction_confidence,
-            ed.is_single_origin,
-            ed.resting_period_days,
-            CASE 
-                WHEN ed.resting_period_days IS NOT NULL THEN ed.resting_period_days * 2
-                ELSE NULL
-            END as adjusted_resting_period_days,
-            ROW_NUMBER() OVER (
-                PARTITION BY v.parent_title, r.name 
-                ORDER BY v.grams
-            ) as rank
+            v.roaster_name,
+            v.grams
         FROM variants v
-        JOIN products p ON v.product_id = p.id
-        JOIN roasters r ON p.roaster_id = r.id
-        LEFT JOIN product_extended_details ed ON p.id = ed.product_id
-        WHERE LOWER(v.option2) LIKE '%bean%'
-        AND (v.option1 like '%250%' OR v.option1 like '%200g%')
-        AND LOWER(v.parent_title) NOT LIKE '%espresso%'
-        AND LOWER(v.parent_title) NOT LIKE '%subscription%'
-        AND LOWER(v.parent_title) NOT LIKE '%decaf%'
-        AND LOWER(v.parent_title) NOT LIKE '%voucher%'
-        AND v.vendor != 'AAZ B2B'
-        AND (v.option3 != 'READY TO DRINK' OR v.option3 IS NULL)
-        AND v.available = 1
+        WHERE v.available = 1
+        AND v.bean_eligible = 1
+    ),
+    min_grams AS (
+        SELECT parent_title, roaster_name, MIN(grams) as grams
+        FROM eligible_variants
+        GROUP BY parent_title, roaster_name
+    ),
+    -- Keep the lightest variant per coffee and roaster, breaking ties on the lowest id
+    chosen_variants AS (
+        SELECT MIN(ev.id) as variant_id
+        FROM eligible_variants ev
+        JOIN min_grams mg ON ev.parent_title = mg.parent_title
+            AND ev.roaster_name = mg.roaster_name
+            AND ev.grams = mg.grams
+        GROUP BY ev.parent_title, ev.roaster_name
     )
     SELECT 
-        rv.parent_title,
-        rv.roaster_name,
-        rv.price,
-        rv.option1,
-        rv.option2,
-        rv.option3,
-        rv.available,
-        rv.product_url,
-        rv.product_id,
-        rv.variant_id,
-        rv.coffee_type,
-        rv.origin_country,
-        rv.origin_region,
-        rv.processing_method,
-        rv.roast_level,
-        rv.varietals,
-        rv.altitude,
-        rv.farm,
-        rv.producer,
-        rv.tasting_notes,
-        rv.extraction_confidence,
-        rv.is_single_origin,
-        rv.resting_period_days,
-        rv.adjusted_resting_period_days,
-        rv.rank
-    FROM ranked_variants rv
-    WHERE rv.rank = 1
+        v.parent_title,
+        v.roaster_name,
+        v.price,
+        v.option1,
+        v.option2,
+        v.option3,
+        v.available,
+        v.product_url,
+        v.product_id,
+        v.id as variant_id,
+        CASE 
+            WHEN v.parent_title_lc LIKE '%blend%' THEN 'Blend'
+            WHEN ed.is_single_origin = 1 THEN 'Single Origin'
+            WHEN ed.is_single_origin = 0 THEN 'Blend'
+            WHEN v.parent_title_lc LIKE '% and %' OR v.parent_title_lc LIKE '% & %' THEN 'Blend'
+            ELSE 'Unknown'
+        END as coffee_type,
+        ed.origin_country,
+        ed.origin_region,
+        ed.processing_method,
+        ed.roast_level,
+        ed.varietals,
+        ed.altitude,
+        ed.farm,
+        ed.producer,
+        ed.tasting_notes,
+        ed.extraction_confidence,
+        ed.is_single_origin,
+        ed.resting_period_days,
+        CASE 
+            WHEN ed.resting_period_days IS NOT NULL THEN ed.resting_period_days * 2
+            ELSE NULL
+        END as adjusted_resting_period_days,
+        1 as rank
+    FROM chosen_variants cv
+    JOIN variants v ON v.id = cv.variant_id
+    LEFT JOIN product_extended_details ed ON v.product_id = ed.product_id
     """
-    with engine.connect() as conn:
-        conn.execute(text(drop_sql))
-        conn.execute(text(view_sql))
+    return replace_view(engine, 'whole_beans_view', view_sql)
+
+def refresh_whole_beans_mat(engine, product_ids=None):
+    """Rebuild whole_beans_mat, a materialized copy of whole_beans_view that readers query instead
+
+    Pass product_ids to refresh only the coffees those products belong to instead of the whole table.
+    """
+    if product_ids is not None and inspect(engine).has_table('whole_beans_mat'):
+        refresh_whole_beans_mat_for_products(engine, product_ids)
+    else:
+        # Dropped and rebuilt in one transaction so readers never see a missing or half-built table
+        run_refresh_script(engine, """
+        BEGIN IMMEDIATE;
+        DROP TABLE IF EXISTS whole_beans_mat;
+        CREATE TABLE whole_beans_mat AS SELECT * FROM whole_beans_view;
+        CREATE INDEX ix_wbm_pv ON whole_beans_mat(product_id, variant_id);
+        CREATE INDEX ix_wbm_rt ON whole_beans_mat(roaster_name, parent_title);
+        """ + WHOLE_BEANS_SEARCH_CREATE_SQL + ";" + WHOLE_BEANS_SEARCH_REBUILD_SQL + ";" + WHOLE_BEANS_GENERATION_SQL + """;
+        COMMIT;
+        """)
+    
+    # Order history shows current product details and status, so its materialized copy follows
+    refresh_order_history_mat(engine)
+
+def refresh_order_history_mat(engine):
+    """Rebuild order_history_mat, a materialized copy of order_history_view that readers query instead"""
+    run_refresh_script(engine, """
+    BEGIN IMMEDIATE;
+    DROP TABLE IF EXISTS order_history_mat;
+    CREATE TABLE order_history_mat AS SELECT * FROM order_history_view;
+    CREATE UNIQUE INDEX ix_ohm_id ON order_history_mat(id);
+    CREATE INDEX ix_ohm_status_date ON order_history_mat(product_status, order_date);
+    COMMIT;
+    """)
+
+def add_to_order_history_mat(session, order_ids):
+    """Copy newly committed orders into order_history_mat without rebuilding it"""
+    session.execute(
+        text("INSERT INTO order_history_mat SELECT * FROM order_history_view WHERE id IN :order_ids")
+        .bindparams(bindparam("order_ids", expanding=True)),
+        {"order_ids": list(order_ids)}
+    )
+    session.commit()
+
+def run_refresh_script(engine, refresh_sql: str):
+    """Run a BEGIN IMMEDIATE ... COMMIT script on a raw connection (pysqlite won't start transactions for DDL itself)"""
+    conn = engine.raw_connection()
+    try:
+        conn.cursor().executescript(refresh_sql)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def refresh_whole_beans_mat_for_products(engine, product_ids):
+    """Re-select the whole_beans_mat rows for the parent_title/roaster groups the given products are in"""
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+    
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        # Take the write lock up front: under WAL, a deferred transaction that reads first fails with
+        # SQLITE_BUSY (without waiting) if the scraper commits before it gets to its first write
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("CREATE TEMP TABLE wbm_refresh_products (product_id INTEGER PRIMARY KEY)")
+        cursor.executemany("INSERT INTO wbm_refresh_products VALUES (?)", [(product_id,) for product_id in product_ids])
+        
+        # A product's coffee can gain or lose its chosen variant, so take the groups it is in now and was in before
+        cursor.execute("""
+        CREATE TEMP TABLE wbm_refresh_groups AS
+        SELECT parent_title, roaster_name FROM variants
+        WHERE product_id IN (SELECT product_id FROM wbm_refresh_products)
+        UNION
+        SELECT parent_title, roaster_name FROM whole_beans_mat
+        WHERE product_id IN (SELECT product_id FROM wbm_refresh_products)
+        """)
+        # Groups are matched with IS so a NULL title or roaster matches itself (a row-value IN never would)
+        cursor.execute("""
+        DELETE FROM whole_beans_mat
+        WHERE EXISTS (
+            SELECT 1 FROM wbm_refresh_groups g
+            WHERE g.parent_title IS whole_beans_mat.parent_title AND g.roaster_name IS whole_beans_mat.roaster_name
+        )
+        """)
+        cursor.execute("""
+        INSERT INTO whole_beans_mat
+        SELECT * FROM whole_beans_view wb
+        WHERE EXISTS (
+            SELECT 1 FROM wbm_refresh_groups g
+            WHERE g.parent_title IS wb.parent_title AND g.roaster_name IS wb.roaster_name
+        )
+        """)
+        cursor.execute("DROP TABLE wbm_refresh_products")
+        cursor.execute("DROP TABLE wbm_refresh_groups")
+        
+        # The search index is small enough that rebuilding it beats tracking the changed rows
+        cursor.execute(WHOLE_BEANS_SEARCH_CREATE_SQL)
+        cursor.execute(WHOLE_BEANS_SEARCH_REBUILD_SQL)
+        cursor.execute(WHOLE_BEANS_GENERATION_SQL)
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-def create_order_history_view(engine):
+def create_order_history_view(engine) -> bool:
     """Create a view combining order history with current product details"""
-    query = text("""
+    view_sql = """
     CREATE VIEW order_history_view AS
     SELECT 
         oh.*,
         r.description as roaster_display_name,
         wb.parent_title,
-        wb.processing_method,
-        wb.origin_country,
-        wb.origin_region,
-        wb.roast_level,
-        wb.tasting_notes
+        wb.processing_method as current_processing_method,
+        wb.origin_country as current_origin_country,
+        wb.origin_region as current_origin_region,
+        wb.roast_level as current_roast_level,
+        wb.tasting_notes as current_tasting_notes,
+        CASE
+            WHEN v.id IS NULL THEN 'Discontinued'
+            WHEN v.available = 1 THEN 'Available'
+            ELSE 'Out of Stock'
+        END as product_status
     FROM order_history oh
-    JOIN whole_beans_view wb ON oh.product_id = wb.product_id
-    JOIN roasters r ON wb.roaster_name = r.name
-    ORDER BY oh.order_date DESC
-    """)
-    
-    with engine.connect() as conn:
-        conn.execute(text("DROP VIEW IF EXISTS order_history_view"))
-        conn.execute(query)
-        conn.commit()
+    LEFT JOIN whole_beans_mat wb ON oh.product_id = wb.product_id
+    LEFT JOIN variants v ON oh.variant_id = v.id
+    LEFT JOIN products p ON oh.product_id = p.id
+    LEFT JOIN roasters r ON p.roaster_id = r.id
+    """
+    return replace_view(engine, 'order_history_view', view_sql)
 
-def create_available_options_view(engine):
+def create_available_options_view(engine) -> bool:
     """Create a view of available coffees that haven't been ordered yet, excluding blends"""
-    drop_query = text("DROP VIEW IF EXISTS available_options_view")
-    
-    create_query = text("""
+    view_sql = """
     CREATE VIEW available_options_view AS
-    SELECT DISTINCT 
+    SELECT 
         wb.*,
-        p.url
-    FROM whole_beans_view wb
-    JOIN products p ON wb.product_id = p.id
-    WHERE NOT EXISTS (
-        SELECT 1 
-        FROM order_history oh 
-        WHERE oh.product_id = wb.product_id
+        wb.product_url as url
+    FROM whole_beans_mat wb
+    LEFT JOIN order_history oh ON oh.product_id = wb.product_id
         AND oh.variant_id = wb.variant_id
-    )
+    WHERE oh.id IS NULL
     AND wb.coffee_type = 'Single Origin'
-    ORDER BY wb.roaster_name, wb.parent_title
-    """)
-    
+    """
+    return replace_view(engine, 'available_options_view', view_sql)
+
+def get_products_for_view(session):
+    """Query products with their roaster and extended details loaded up front.
+
+    Set COFFEE_STRICT_LOADS=1 to make any other relationship access raise instead of lazy loading.
+    """
+    query = session.query(Product).options(
+        joinedload(Product.roaster),
+        joinedload(Product.extended_details)
+    )
+    if os.environ.get("COFFEE_STRICT_LOADS"):
+        query = query.options(raiseload('*'))
+    return query
+
+def bulk_insert_variants(session, rows):
+    """Insert variant rows in bulk, skipping the ORM unit of work
+
+    Each scrape stores its products as new rows, so their variants are always new too.
+    """
+    if not rows:
+        return
+
+    session.execute(insert(Variant.__table__), rows)
+
+def upsert_extended_details(session, rows):
+    """Insert or replace extended detail rows by product_id in one statement, without reading them first"""
+    if not rows:
+        return
+
+    stmt = insert(ProductExtendedDetails.__table__)
+    # Generated columns are computed by SQLite and can't be written
+    writable = [c.name for c in ProductExtendedDetails.__table__.c
+                if c.name not in ('id', 'product_id', 'last_updated') and c.computed is None]
+    set_ = {name: stmt.excluded[name] for name in writable}
+    set_['last_updated'] = local_now()
+    stmt = stmt.on_conflict_do_update(index_elements=['product_id'], set_=set_)
+    session.execute(stmt, rows)
+
+# Extracted fields copied between rows of the same product (generated columns are computed by SQLite)
+EXTENDED_DETAILS_COPY_COLUMNS = ', '.join(
+    c.name for c in ProductExtendedDetails.__table__.c
+    if c.name not in ('id', 'product_id', 'last_updated') and c.computed is None
+)
+
+# Each scrape stores products as new rows, so fill in a new row's details from the latest earlier row
+# of the same product (same URL) with the same content hash
+EXTENDED_DETAILS_REUSE_SQL = text(f"""
+    INSERT INTO product_extended_details (product_id, {EXTENDED_DETAILS_COPY_COLUMNS}, last_updated)
+    SELECT p.id, {', '.join('ed.' + name for name in EXTENDED_DETAILS_COPY_COLUMNS.split(', '))}, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
+    FROM products p
+    JOIN product_extended_details ed ON ed.product_id = (
+        SELECT MAX(prev.id)
+        FROM products prev
+        JOIN product_extended_details prev_ed ON prev_ed.product_id = prev.id
+        WHERE prev.url = p.url AND prev.content_hash = p.content_hash AND prev.id < p.id
+    )
+    WHERE p.content_hash IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM product_extended_details own WHERE own.product_id = p.id)
+    RETURNING product_id
+""")
+
+def reuse_extended_details(session):
+    """Copy extended details onto re-scraped products whose content is unchanged, returning their ids"""
+    return session.execute(EXTENDED_DETAILS_REUSE_SQL).scalars().all()
+
+@contextmanager
+def query_counter(conn=None):
+    """Count the SQL statements run on an engine or connection while the block runs.
+
+    Yields a list of the statements, so len() gives the count. Handy for spotting N+1 loads:
+
+        with query_counter() as statements:
+            ...
+        print(len(statements))
+    """
+    target = conn if conn is not None else engine
+    statements = []
+
+    def _count(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(target, "before_cursor_execute", _count)
+    try:
+        yield statements
+    finally:
+        event.remove(target, "before_cursor_execute", _count)
+
+def optimize_db(engine):
+    """Let SQLite refresh planner statistics for tables whose contents changed a lot (after bulk loads)"""
     with engine.connect() as conn:
-        conn.execute(drop_query)
-        conn.execute(create_query)
-        conn.commit()
+        conn.exec_driver_sql("PRAGMA optimize")
 
 def get_session():
     """Get a new database session"""
-    Session = sessionmaker(bind=engine)
-    return Session()
+    return SessionLocal()
+
+@contextmanager
+def session_scope(session=None):
+    """Yield the caller's session, or a new one that is closed (returning its connection to the pool) afterwards"""
+    if session is not None:
+        yield session
+        return
+    with SessionLocal() as new_session:
+        yield new_session
@@ -1,30 +1,143 @@
-from coffee_copilot.database import get_session, Product, ProductExtendedDetails, ProductImage
+from coffee_copilot.database import get_session, session_scope, get_products_for_view, refresh_whole_beans_mat, upsert_extended_details, reuse_extended_details, engine, Product, ProductImage
 from coffee_copilot.ai_coffee_extractor import AICoffeeExtractor
+from coffee_copilot.config import config
 from sqlalchemy import text
-from datetime import datetime
+from sqlalchemy.orm import selectinload
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from requests.adapters import HTTPAdapter
 import requests
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+
+# Extended details are written in batches of this many products per transaction
+COMMIT_BATCH_SIZE = 20
+
+# Products are sent to the AI extractor concurrently, this many at a time
+EXTRACT_WINDOW = 16
+
+# Product records are loaded from the database this many at a time
+PRODUCT_CHUNK_SIZE = 100
+
+# Product pages are fetched in the background, this many at once and up to FETCH_AHEAD ahead of extraction
+FETCH_WORKERS = 16
+FETCH_AHEAD = 32
+
+# Shared session so fetches reuse pooled connections to each roaster's site
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
+
+# Fetched product pages are kept on disk so re-runs don't download them again
+scraping_config = config.get('scraping', {})
+html_cache_enabled = scraping_config.get('html_cache_enabled', True)
+html_cache_ttl_seconds = scraping_config.get('html_cache_ttl_days', 14) * 86400
+html_cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'html_cache')
+
+# Bound each fetch so a slow or huge page can't stall enhancement
+fetch_timeout = (scraping_config.get('connect_timeout_seconds', 3), scraping_config.get('read_timeout_seconds', 10))
+max_page_bytes = scraping_config.get('max_page_bytes', 1_000_000)
+if html_cache_enabled:
+    os.makedirs(html_cache_dir, exist_ok=True)
+
+def _html_cache_path(url):
+    return os.path.join(html_cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.html.gz')
 
 def get_product_html(url):
     """Get the complete HTML content from a product URL"""
+    cache_path = None
+    if html_cache_enabled and url:
+        cache_path = _html_cache_path(url)
+        try:
+            if time.time() - os.path.getmtime(cache_path) < html_cache_ttl_seconds:
+                with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+                    return f.read()
+        except (OSError, EOFError):
+            pass
+    
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.text
+        # Stream the body and decode only the first max_page_bytes of it
+        with http_session.get(url, timeout=fetch_timeout, stream=True) as response:
+            response.raise_for_status()
+            content = response.raw.read(max_page_bytes, decode_content=True)
+            html = content.decode(response.encoding or 'utf-8', errors='replace')
     except Exception as e:
         print(f"Error fetching URL {url}: {str(e)}")
         return None
+    
+    if cache_path:
+        # Write to a temp file first so concurrent fetches never read a partial page
+        fd, tmp_path = tempfile.mkstemp(dir=html_cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(tmp_path, cache_path)
+    return html
+
+_NO_MORE_URLS = object()
+
+def prefetch_product_html(urls):
+    """Yield the HTML for each URL in order, fetching the next FETCH_AHEAD pages in the background"""
+    urls = iter(urls)
+    executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    try:
+        pending = deque(executor.submit(get_product_html, url) for _, url in zip(range(FETCH_AHEAD), urls))
+        while pending:
+            html = pending.popleft().result()
+            next_url = next(urls, _NO_MORE_URLS)
+            if next_url is not _NO_MORE_URLS:
+                pending.append(executor.submit(get_product_html, next_url))
+            yield html
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-def enhance_products():
-    """Enhance all products from the whole_beans_view with AI-extracted coffee data"""
+def iter_products_with_first_image(session, product_ids):
+    """Yield the Product for each id in order (None if missing), loading PRODUCT_CHUNK_SIZE at a time
+
+    Each chunk is two queries, the products and their first images, rather than two queries per
+    product, and only one chunk of descriptions is held in memory at once.
+    """
+    for start in range(0, len(product_ids), PRODUCT_CHUNK_SIZE):
+        chunk = product_ids[start:start + PRODUCT_CHUNK_SIZE]
+        loaded = {
+            db_product.id: db_product
+            for db_product in get_products_for_view(session)
+            .filter(Product.id.in_(chunk))
+            .options(selectinload(Product.images.and_(ProductImage.position == 1)))
+        }
+        for product_id in chunk:
+            yield loaded.get(product_id)
+
+def batch_mode_enabled():
+    """Whether enhancement goes through the Batch API by default (COFFEE_ENHANCE_BATCH=1)"""
+    return os.environ.get('COFFEE_ENHANCE_BATCH') == '1'
+
+def enhance_products(use_batch=None):
+    """Enhance all products from the whole_beans_view with AI-extracted coffee data
+
+    With use_batch (or COFFEE_ENHANCE_BATCH=1), every product goes into one Batch API job,
+    which is cheaper but can take up to 24 hours. Returns the number of products that were
+    waiting to be enhanced.
+    """
+    if use_batch is None:
+        use_batch = batch_mode_enabled()
     session = get_session()
-    extractor = AICoffeeExtractor()
+    extractor = AICoffeeExtractor.get()
+
+    # Re-scraped products whose content hasn't changed keep the details extracted last time
+    reused_product_ids = reuse_extended_details(session)
+    session.commit()
+    if reused_product_ids:
+        print(f"Reused extended details for {len(reused_product_ids)} unchanged products")
 
     # Get all products from the whole_beans_view that haven't been enhanced yet
     view_query = """
-    SELECT DISTINCT v.parent_title, v.product_url, p.body_html, p.tags
+    SELECT DISTINCT v.product_id, v.parent_title, v.product_url
     FROM whole_beans_view v
     LEFT JOIN product_extended_details ed ON v.product_id = ed.product_id
-    JOIN products p ON v.product_id = p.id
     WHERE ed.id IS NULL
     ORDER BY v.parent_title
     """
@@ -32,107 +145,153 @@ def enhance_products():
     products = session.execute(text(view_query)).fetchall()
     total_products = len(products)
     print(f"Found {total_products} products to enhance")
+    if not products:
+        session.close()
+        if reused_product_ids:
+            refresh_whole_beans_mat(engine, reused_product_ids)
+        return 0
 
-    # Process each product
-    for i, product in enumerate(products, 1):
-        print(f"\nProcessing [{i}/{total_products}]: {product.parent_title}")
-        print(f"URL: {product.product_url}")
-        print(f"Body HTML length: {len(product.body_html) if product.body_html else 0}")  # Debug line
+    # Product records (with their descriptions) are streamed in chunks alongside the loop
+    db_products = iter_products_with_first_image(session, [product.product_id for product in products])
+
+    # Extended detail rows waiting to be written in the next batch
+    pending = []
+    enhanced_product_ids = list(reused_product_ids)
+
+    def flush_pending():
+        if pending:
+            upsert_extended_details(session, pending)
+            session.commit()
+            pending.clear()
+
+    # Products waiting to be extracted together, as (product, db_product, extractor kwargs)
+    window = []
+    # In batch mode each window is written to the job's input file, keeping only (product, product id) for the results
+    offline_batch = extractor.open_offline_batch() if use_batch else None
+    batched = []
+
+    def store_result(product, product_id, coffee_data):
+        if coffee_data is None:
+            # Nothing is stored for a failed extraction, so the next run picks the product up again
+            print(f"No extended details stored for {product.parent_title}; it will be retried next run")
+            return
+        print_extracted_data(product, coffee_data)
         
-        # Get the complete HTML content
-        scraped_html = get_product_html(product.product_url)
+        # Queue the extended details and write them out a batch at a time
+        pending.append(build_extended_details_row(product_id, coffee_data))
+        enhanced_product_ids.append(product_id)
+        if len(pending) >= COMMIT_BATCH_SIZE:
+            flush_pending()
+
+    def extract_window():
+        if not window:
+            return
+        items = [item for _, _, item in window]
+        if use_batch:
+            offline_batch.add(items)
+            batched.extend((product, db_product.id) for product, db_product, _ in window)
+        else:
+            results = extractor.run(extractor.extract_coffee_data_many_async(items))
+            for (product, db_product, _), coffee_data in zip(window, results):
+                store_result(product, db_product.id, coffee_data)
+        window.clear()
+
+    # Page fetches overlap with extraction of earlier products
+    scraped_pages = prefetch_product_html(product.product_url for product in products)
+
+    # Process each product
+    try:
+        for (i, product), db_product, scraped_html in zip(enumerate(products, 1), db_products, scraped_pages):
+            print(f"\nProcessing [{i}/{total_products}]: {product.parent_title}")
+            print(f"URL: {product.product_url}")
         
-        # Get the product record
-        db_product = session.query(Product).filter(Product.url == product.product_url).first()
-        if not db_product:
-            print(f"Error: Could not find product with URL {product.product_url}")
-            continue
+            if not db_product:
+                print(f"Error: Could not find product with URL {product.product_url}")
+                continue
+            print(f"Body HTML length: {len(db_product.body_html) if db_product.body_html else 0}")  # Debug line
             
-        # Get the first product image URL if available
-        first_image = session.query(ProductImage).filter(
-            ProductImage.product_id == db_product.id,
-            ProductImage.position == 1
-        ).first()
-        image_url = first_image.src if first_image else None
+            # Get the first product image URL if available
+            image_url = db_product.images[0].src if db_product.images else None
 
-        try:
-            # Extract coffee data using AI
-            coffee_data = extractor.extract_coffee_data(
-                body_html=product.body_html,
-                tags=product.tags.split(',') if product.tags else [],
+            # Queue the product for extraction with the rest of its window
+            window.append((product, db_product, dict(
+                body_html=db_product.body_html,
+                tags=db_product.tags.split(',') if db_product.tags else [],
                 scraped_html=scraped_html,
                 parent_title=product.parent_title,
                 image_url=image_url
-            )
-        except Exception as e:
-            print(f"Error extracting coffee data: {str(e)}")
-            coffee_data = extractor._get_empty_result()
-        
-        print_extracted_data(product, coffee_data)
-        
-        # Store the extended details
-        store_extended_details(db_product, coffee_data, session)
-        session.commit()  # Commit after each product to avoid losing progress
+            )))
+            if len(window) >= EXTRACT_WINDOW:
+                extract_window()
+        extract_window()
+        if use_batch:
+            for (product, product_id), coffee_data in zip(batched, offline_batch.submit()):
+                store_result(product, product_id, coffee_data)
+    finally:
+        # Stop any outstanding fetches and keep whatever was extracted before a failure or interrupt
+        scraped_pages.close()
+        if offline_batch:
+            offline_batch.close()
+        flush_pending()
+        session.close()
         
+    # Extended details feed coffee_type and origins, so refresh those coffees in the materialized beans table
+    refresh_whole_beans_mat(engine, enhanced_product_ids)
     print("\nAll products have been enhanced")
+    return total_products
 
 def print_extracted_data(product, coffee_data):
     """Print extracted coffee data in a readable format"""
-    print(f"\nProcessing: {product.parent_title}")
-    print(f"URL: {product.product_url}")
-    print()
-    
-    print("Raw coffee_data:")
-    print(coffee_data)
-    print()
-    
-    print("Extracted Data:")
-    print(f"Type: {'Single Origin' if coffee_data.get('is_single_origin') else ('Blend' if coffee_data.get('is_single_origin') == False else 'Unknown')}")
-    print(f"Origin: {coffee_data.get('origin', {}).get('country')}, {coffee_data.get('origin', {}).get('region')}")
-    print(f"Roast Level: {coffee_data.get('roast_level')}")
-    print(f"Process: {coffee_data.get('processing_method')}")
+    # Build the report and write it in one go, so concurrent output doesn't interleave line by line
+    lines = [
+        f"\nProcessing: {product.parent_title}",
+        f"URL: {product.product_url}",
+        "",
+        "Raw coffee_data:",
+        str(coffee_data),
+        "",
+        "Extracted Data:",
+        f"Type: {'Single Origin' if coffee_data.get('is_single_origin') else ('Blend' if coffee_data.get('is_single_origin') == False else 'Unknown')}",
+        f"Origin: {coffee_data.get('origin', {}).get('country')}, {coffee_data.get('origin', {}).get('region')}",
+        f"Roast Level: {coffee_data.get('roast_level')}",
+        f"Process: {coffee_data.get('processing_method')}"
+    ]
     
     # Handle varietals that might be None
     varietals = coffee_data.get('varietals')
     if varietals:
         if isinstance(varietals, str):
-            print(f"Varietals: {varietals}")
+            lines.append(f"Varietals: {varietals}")
         else:
-            print(f"Varietals: {', '.join(varietals)}")
+            lines.append(f"Varietals: {', '.join(varietals)}")
     else:
-        print("Varietals: None")
+        lines.append("Varietals: None")
         
-    print(f"Farm: {coffee_data.get('farm')}")
-    print(f"Producer: {coffee_data.get('producer')}")
-    print(f"Altitude: {coffee_data.get('altitude')}")
+    lines.append(f"Farm: {coffee_data.get('farm')}")
+    lines.append(f"Producer: {coffee_data.get('producer')}")
+    lines.append(f"Altitude: {coffee_data.get('altitude')}")
     
     # Print categorized tasting notes
     tasting_notes = coffee_data.get('tasting_notes', {})
-    print("Tasting Notes:")
+    lines.append("Tasting Notes:")
     for category in ['fruits', 'sweets', 'florals', 'spices', 'others']:
         notes = tasting_notes.get(category, [])
         if notes:
-            print(f"  {category.title()}: {', '.join(notes)}")
+            lines.append(f"  {category.title()}: {', '.join(notes)}")
         
-    print(f"Recommended Rest: {coffee_data.get('resting_period_days')} days")
-    print(f"Confidence: {coffee_data.get('confidence_score', 0.0):.2f}\n")
+    lines.append(f"Recommended Rest: {coffee_data.get('resting_period_days')} days")
+    lines.append(f"Confidence: {coffee_data.get('confidence_score', 0.0):.2f}\n")
+    print('\n'.join(lines))
 
-def store_extended_details(product, coffee_data, session):
-    """Store the extended details, handling missing or empty data safely"""
-    # Check if there's an existing record
-    existing = session.query(ProductExtendedDetails).filter_by(product_id=product.id).first()
-    if existing:
-        session.delete(existing)
-        session.commit()
-    
+def build_extended_details_row(product_id, coffee_data):
+    """Build a product_extended_details row from extracted data, handling missing or empty data safely"""
     # Handle farm data - if it's a list, join with commas
     farm = coffee_data.get('farm')
     if isinstance(farm, list):
         farm = ', '.join(farm)
     
-    # Store the extended details
-    extended_details = ProductExtendedDetails(
-        product_id=product.id,
+    return dict(
+        product_id=product_id,
         is_single_origin=1 if coffee_data.get('is_single_origin') == True else (0 if coffee_data.get('is_single_origin') == False else None),
         origin_country=coffee_data.get('origin', {}).get('country'),
         origin_region=coffee_data.get('origin', {}).get('region'),
@@ -144,70 +303,67 @@ def store_extended_details(product, coffee_data, session):
         producer=coffee_data.get('producer'),
         tasting_notes=coffee_data.get('tasting_notes'),
         resting_period_days=coffee_data.get('resting_period_days'),
-        extraction_confidence=coffee_data.get('confidence_score', 0.0),
-        last_updated=datetime.now()
+        extraction_confidence=coffee_data.get('confidence_score', 0.0)
     )
-    session.add(extended_details)
+
+def store_extended_details(product, coffee_data, session):
+    """Store the extended details for a single product, replacing any existing record"""
+    upsert_extended_details(session, [build_extended_details_row(product.id, coffee_data)])
 
 def enhance_single_product(product_id: int, session=None):
     """Enhance a single product with AI extraction"""
-    session_created = False
-    if session is None:
-        session = get_session()
-        session_created = True
-        
-    try:
-        # Get the product
-        product = session.query(Product).filter(Product.id == product_id).first()
-        if not product:
-            print(f"Product {product_id} not found")
-            return
+    with session_scope(session) as session:
+        try:
+            # Get the product with just its first image
+            product = (
+                get_products_for_view(session)
+                .options(selectinload(Product.images.and_(ProductImage.position == 1)))
+                .filter(Product.id == product_id)
+                .first()
+            )
+            if not product:
+                print(f"Product {product_id} not found")
+                return
             
-        # Initialize AI extractor
-        extractor = AICoffeeExtractor()
+            # Initialize AI extractor
+            extractor = AICoffeeExtractor.get()
         
-        print(f"\nProcessing: {product.title}")
-        print(f"URL: {product.url}")
+            print(f"\nProcessing: {product.title}")
+            print(f"URL: {product.url}")
         
-        # Get the complete HTML content
-        scraped_html = get_product_html(product.url)
+            # Get the complete HTML content
+            scraped_html = get_product_html(product.url)
         
-        # Get the first product image URL if available
-        first_image = session.query(ProductImage).filter(
-            ProductImage.product_id == product.id,
-            ProductImage.position == 1
-        ).first()
-        image_url = first_image.src if first_image else None
+            # Get the first product image URL if available
+            image_url = product.images[0].src if product.images else None
         
-        if image_url:
-            print(f"Image URL: {image_url}")
-        else:
-            print("No image found")
+            if image_url:
+                print(f"Image URL: {image_url}")
+            else:
+                print("No image found")
 
-        try:
-            # Extract coffee data using AI
-            coffee_data = extractor.extract_coffee_data(
-                body_html=product.body_html,
-                tags=product.tags.split(',') if product.tags else [],
-                scraped_html=scraped_html,
-                parent_title=product.parent_title,
-                image_url=image_url
-            )
-        except Exception as e:
-            print(f"Error extracting coffee data: {str(e)}")
-            coffee_data = extractor._get_empty_result()
+            try:
+                # Extract coffee data using AI
+                coffee_data = extractor.extract_coffee_data(
+                    body_html=product.body_html,
+                    tags=product.tags.split(',') if product.tags else [],
+                    scraped_html=scraped_html,
+                    parent_title=product.parent_title,
+                    image_url=image_url
+                )
+            except Exception as e:
+                print(f"Error extracting coffee data: {str(e)}")
+                coffee_data = extractor._get_empty_result()
         
-        print_extracted_data(product, coffee_data)
+            print_extracted_data(product, coffee_data)
         
-        # Store the extended details
-        store_extended_details(product, coffee_data, session)
-        session.commit()
+            # Store the extended details
+            store_extended_details(product, coffee_data, session)
+            session.commit()
+            refresh_whole_beans_mat(engine, [product.id])
         
-    except Exception as e:
-        print(f"Error processing product {product_id}: {str(e)}")
-    finally:
-        if session_created and session:
-            session.close()
+        except Exception as e:
+            print(f"Error processing product {product_id}: {str(e)}")
 
 if __name__ == "__main__":
     enhance_single_product(8)
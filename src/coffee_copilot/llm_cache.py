@@ -0,0 +1,55 @@
+import hashlib
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+# Cache records are read and written with orjson when it's available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bump whenever the extraction prompt changes so stale responses aren't reused
+PROMPT_VERSION = "v6"
+DEFAULT_TTL_DAYS = 7
+
+# Create cache directory if it doesn't exist
+cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'llm_cache')
+os.makedirs(cache_dir, exist_ok=True)
+
+def make_key(**parts) -> str:
+    """Build a SHA-256 cache key from the prompt version and the given inputs"""
+    payload = json.dumps({"prompt_version": PROMPT_VERSION, **parts}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _path(key: str) -> str:
+    return os.path.join(cache_dir, f"{key}.json")
+
+def get(key: str) -> Optional[Any]:
+    """Return the cached value for a key, or None if missing or expired"""
+    try:
+        with open(_path(key), 'rb') as f:
+            data = f.read()
+        record = orjson.loads(data) if orjson else json.loads(data)
+    except (OSError, ValueError):
+        return None
+
+    if datetime.fromisoformat(record['expiresAt']) < datetime.now():
+        return None
+    return record['value']
+
+def set(key: str, value: Any, ttl_days: float = DEFAULT_TTL_DAYS):
+    """Store a value under a key, expiring after ttl_days"""
+    record = {
+        "expiresAt": (datetime.now() + timedelta(days=ttl_days)).isoformat(),
+        "value": value
+    }
+
+    # Write to a temp file first so readers never see a partial record
+    data = orjson.dumps(record) if orjson else json.dumps(record).encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, _path(key))
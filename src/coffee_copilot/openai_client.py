@@ -0,0 +1,39 @@
+from functools import lru_cache
+import os
+import httpx
+from dotenv import load_dotenv
+from openai import AzureOpenAI, AsyncAzureOpenAI
+
+# Keep enough idle connections around for concurrent extraction to reuse sockets
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20)
+
+# Used by both clients when AZURE_OPENAI_API_VERSION isn't set
+DEFAULT_API_VERSION = "2024-02-15-preview"
+
+@lru_cache(maxsize=1)
+def get_client() -> AzureOpenAI:
+    """Return the shared Azure OpenAI client, creating it on first use"""
+    # Load environment variables
+    load_dotenv()
+    
+    return AzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION", DEFAULT_API_VERSION),
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        http_client=httpx.Client(limits=HTTP_LIMITS)
+    )
+
+def create_async_client() -> AsyncAzureOpenAI:
+    """Create an async Azure OpenAI client
+
+    Async clients are bound to the event loop they first run on, so callers keep
+    one per loop rather than sharing a single instance.
+    """
+    load_dotenv()
+    
+    return AsyncAzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION", DEFAULT_API_VERSION),
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        http_client=httpx.AsyncClient(limits=HTTP_LIMITS)
+    )
@@ -1,10 +1,114 @@
 from datetime import datetime
 import json
 from typing import Optional, Dict, Any
-from coffee_copilot.database import get_session, Product, Variant, ProductExtendedDetails, OrderHistory
-from sqlalchemy import text
+from coffee_copilot.database import get_session, session_scope, get_products_for_view, add_to_order_history_mat, whole_beans_mat, whole_beans_search, Product, Variant, ProductExtendedDetails, OrderHistory
+from sqlalchemy import text, select, bindparam
 import logging
 
+# Statements are built once so SQLAlchemy compiles each a single time and reuses it from the statement cache
+FIND_BEANS_SELECT = select(
+    whole_beans_mat.c.product_id,
+    whole_beans_mat.c.parent_title,
+    whole_beans_mat.c.roaster_name,
+    whole_beans_mat.c.price,
+    # The product's first variant, fetched in the same statement
+    select(Variant.id).where(Variant.product_id == whole_beans_mat.c.product_id).limit(1).scalar_subquery().label('variant_id')
+).where(whole_beans_mat.c.product_id.in_(
+    select(whole_beans_search.c.rowid).where(whole_beans_search.c.parent_title.like(bindparam('name')))
+))
+
+# The order history list only needs these columns; get_order_details returns every column
+ORDER_HISTORY_COLUMNS = """
+        id,
+        product_status,
+        order_date,
+        product_id,
+        variant_id,
+        parent_title,
+        product_title,
+        roaster_name,
+        roaster_display_name,
+        processing_method,
+        origin_country,
+        tasting_notes,
+        price_paid,
+        product_url
+"""
+
+ORDER_HISTORY_SELECT = text(f"""
+    SELECT {ORDER_HISTORY_COLUMNS}
+    FROM order_history_mat
+    ORDER BY order_date DESC
+""")
+
+CURRENT_ORDER_HISTORY_SELECT = text(f"""
+    SELECT {ORDER_HISTORY_COLUMNS}
+    FROM order_history_mat
+    WHERE product_status != 'Discontinued'
+    ORDER BY order_date DESC
+""")
+
+ORDER_DETAILS_SELECT = text("""
+    SELECT *
+    FROM order_history_mat
+    WHERE id = :order_id
+""")
+
+# The columns _order_history_row reads for an available variant, and the joins they come from
+COFFEE_OPTION_COLUMNS = """
+        wb.product_id,
+        wb.variant_id,
+        r.description as roaster_name,
+        wb.parent_title,
+        wb.url as product_url,
+        v.option1,
+        v.option2,
+        v.option3,
+        wb.price as price_paid,
+        ed.is_single_origin,
+        wb.origin_country,
+        ed.origin_region,
+        ed.roast_level,
+        wb.processing_method,
+        ed.varietals,
+        ed.altitude,
+        ed.farm,
+        ed.producer,
+        wb.tasting_notes
+"""
+
+COFFEE_OPTION_FROM = """
+    FROM available_options_view wb
+    JOIN roasters r ON wb.roaster_name = r.name
+    JOIN variants v ON wb.product_id = v.product_id AND wb.variant_id = v.id
+    LEFT JOIN product_extended_details ed ON wb.product_id = ed.product_id
+"""
+
+COFFEE_BY_ID_OR_TITLE_SELECT = text(f"""
+    SELECT * FROM (
+        SELECT 1 as priority, wb.roaster_name as roaster_key, {COFFEE_OPTION_COLUMNS}
+        {COFFEE_OPTION_FROM}
+        WHERE wb.product_id = :product_id
+        AND wb.variant_id = :variant_id
+        UNION ALL
+        SELECT 2 as priority, wb.roaster_name as roaster_key, {COFFEE_OPTION_COLUMNS}
+        {COFFEE_OPTION_FROM}
+        WHERE wb.parent_title = :title
+        AND v.option2 = 'Whole Bean'
+    )
+    ORDER BY priority, roaster_key
+    LIMIT 1
+""")
+
+COFFEE_BY_TITLE_SELECT = text(f"""
+    SELECT {COFFEE_OPTION_COLUMNS}
+    {COFFEE_OPTION_FROM}
+    WHERE wb.parent_title = :title
+    AND v.option2 = 'Whole Bean'
+    ORDER BY wb.roaster_name
+    LIMIT 1
+""")
+
 def add_order(
     product_id: int,
     variant_id: int,
@@ -32,63 +136,58 @@ def add_order(
     Raises:
         ValueError: If the product or variant is not found
     """
-    session_created = False
-    if session is None:
-        session = get_session()
-        session_created = True
-        
-    try:
-        # Get the product and its relationships
-        product = session.query(Product).filter(Product.id == product_id).first()
-        if not product:
-            raise ValueError(f"Product with ID {product_id} not found")
+    with session_scope(session) as session:
+        try:
+            # Get the product and its relationships
+            product = get_products_for_view(session).filter(Product.id == product_id).first()
+            if not product:
+                raise ValueError(f"Product with ID {product_id} not found")
             
-        variant = session.query(Variant).filter(Variant.id == variant_id).first()
-        if not variant:
-            raise ValueError(f"Variant with ID {variant_id} not found")
+            # Primary key lookup, answered from the identity map if the variant is already loaded
+            variant = session.get(Variant, variant_id)
+            if not variant:
+                raise ValueError(f"Variant with ID {variant_id} not found")
             
-        extended_details = product.extended_details
+            extended_details = product.extended_details
         
-        # Create order history entry
-        order = OrderHistory(
-            product_id=product.id,
-            variant_id=variant.id,
-            quantity=quantity,
-            price_paid=price_paid,
-            notes=notes,
-            order_date=order_date or datetime.now(),
+            # Create order history entry
+            order = OrderHistory(
+                product_id=product.id,
+                variant_id=variant.id,
+                quantity=quantity,
+                price_paid=price_paid,
+                notes=notes,
+                order_date=order_date or datetime.now(),
             
-            # Store product details at time of purchase
-            roaster_name=product.roaster.name,
-            product_title=product.parent_title or product.title,
-            product_url=product.url,
-            option1=variant.option1,
-            option2=variant.option2,
-            option3=variant.option3,
+                # Store product details at time of purchase
+                roaster_name=product.roaster.name,
+                product_title=product.parent_title or product.title,
+                product_url=product.url,
+                option1=variant.option1,
+                option2=variant.option2,
+                option3=variant.option3,
             
-            # Store coffee attributes at time of purchase
-            is_single_origin=extended_details.is_single_origin if extended_details else None,
-            origin_country=extended_details.origin_country if extended_details else None,
-            origin_region=extended_details.origin_region if extended_details else None,
-            roast_level=extended_details.roast_level if extended_details else None,
-            processing_method=extended_details.processing_method if extended_details else None,
-            varietals=extended_details.varietals if extended_details else None,
-            altitude=extended_details.altitude if extended_details else None,
-            farm=extended_details.farm if extended_details else None,
-            producer=extended_details.producer if extended_details else None,
-            tasting_notes=extended_details.tasting_notes if extended_details else None
-        )
+                # Store coffee attributes at time of purchase
+                is_single_origin=extended_details.is_single_origin if extended_details else None,
+                origin_country=extended_details.origin_country if extended_details else None,
+                origin_region=extended_details.origin_region if extended_details else None,
+                roast_level=extended_details.roast_level if extended_details else None,
+                processing_method=extended_details.processing_method if extended_details else None,
+                varietals=extended_details.varietals if extended_details else None,
+                altitude=extended_details.altitude if extended_details else None,
+                farm=extended_details.farm if extended_details else None,
+                producer=extended_details.producer if extended_details else None,
+                tasting_notes=extended_details.tasting_notes if extended_details else None
+            )
         
-        session.add(order)
-        session.commit()
-        return order
+            session.add(order)
+            session.commit()
+            add_to_order_history_mat(session, [order.id])
+            return order
         
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        if session_created:
-            session.close()
+        except Exception as e:
+            session.rollback()
+            raise e
 
 def get_order_history(include_discontinued: bool = True, session = None) -> Dict[str, Any]:
     """
@@ -99,31 +198,16 @@ def get_order_history(include_discontinued: bool = True, session = None) -> Dict
         session: Optional database session (will create one if not provided)
     
     Returns:
-        Dictionary containing lists of orders grouped by status:
+        Dictionary containing lists of orders (the ORDER_HISTORY_COLUMNS of each)
+        grouped by status:
         {
             "available": [...],
             "out_of_stock": [...],
             "discontinued": [...]  # Only if include_discontinued is True
         }
     """
-    session_created = False
-    if session is None:
-        session = get_session()
-        session_created = True
-        
-    try:
-        # Build the query
-        query = """
-        SELECT *
-        FROM order_history_view
-        WHERE 1=1
-        """
-        if not include_discontinued:
-            query += " AND product_status != 'Discontinued'"
-        query += " ORDER BY order_date DESC"
-        
-        # Execute with text() wrapper
-        results = session.execute(text(query)).fetchall()
+    with session_scope(session) as session:
+        query = ORDER_HISTORY_SELECT if include_discontinued else CURRENT_ORDER_HISTORY_SELECT
         
         # Group orders by status
         orders = {
@@ -132,18 +216,15 @@ def get_order_history(include_discontinued: bool = True, session = None) -> Dict
             "discontinued": [] if include_discontinued else None
         }
         
-        for row in results:
+        # Stream the rows in batches rather than fetching them all first
+        for row in session.execute(query).yield_per(256):
             # Convert SQLAlchemy Row to dict
-            row_dict = {key: getattr(row, key) for key in row._fields}
+            row_dict = row._asdict()
             status = row_dict["product_status"].lower().replace(" ", "_")
             if status in orders and orders[status] is not None:
                 orders[status].append(row_dict)
         
         return orders
-        
-    finally:
-        if session_created:
-            session.close()
 
 def get_order_details(order_id: int, session = None) -> Dict[str, Any]:
     """
@@ -159,33 +240,18 @@ def get_order_details(order_id: int, session = None) -> Dict[str, Any]:
     Raises:
         ValueError: If the order is not found
     """
-    session_created = False
-    if session is None:
-        session = get_session()
-        session_created = True
-        
-    try:
-        # Query the order_history_view for this specific order
-        query = text("""
-        SELECT *
-        FROM order_history_view
-        WHERE id = :order_id
-        """)
-        
-        result = session.execute(query, {"order_id": order_id}).first()
+    with session_scope(session) as session:
+        # Query the materialized order history for this specific order
+        result = session.execute(ORDER_DETAILS_SELECT, {"order_id": order_id}).first()
         if not result:
             raise ValueError(f"Order with ID {order_id} not found")
             
         # Convert SQLAlchemy Row to dict
         return {key: getattr(result, key) for key in result._fields}
-        
-    finally:
-        if session_created:
-            session.close()
 
 def find_product_by_name(name: str, session = None) -> Dict[str, Any]:
     """
-    Find a product in the whole_beans_view by its name.
+    Find a product in the whole beans table by its name.
     Performs a case-insensitive partial match.
     
     Args:
@@ -195,24 +261,9 @@ def find_product_by_name(name: str, session = None) -> Dict[str, Any]:
     Returns:
         Dictionary with product details if found, None if not found
     """
-    session_created = False
-    if session is None:
-        session = get_session()
-        session_created = True
-        
-    try:
-        # First get the product from whole_beans_view
-        query = text("""
-        SELECT 
-            product_id,
-            parent_title,
-            roaster_name,
-            price
-        FROM whole_beans_view
-        WHERE LOWER(parent_title) LIKE :name
-        """)
-        
-        result = session.execute(query, {"name": f"%{name.lower()}%"}).fetchall()
+    with session_scope(session) as session:
+        # First get the product from whole_beans_mat
+        result = session.execute(FIND_BEANS_SELECT, {"name": f"%{name.lower()}%"}).fetchall()
         
         if not result:
             return None
@@ -230,180 +281,93 @@ def find_product_by_name(name: str, session = None) -> Dict[str, Any]:
             "product_id": row.product_id,
             "parent_title": row.parent_title,
             "roaster_name": row.roaster_name,
-            "price": row.price
+            "price": row.price,
+            "variant_id": row.variant_id
         }
         
-        # Get the first available variant for this product
-        variant_query = text("""
-        SELECT id 
-        FROM variants 
-        WHERE product_id = :product_id 
-        LIMIT 1
-        """)
-        
-        variant = session.execute(variant_query, {"product_id": product["product_id"]}).first()
-        if not variant:
+        if product["variant_id"] is None:
             print(f"No variants found for product {product['parent_title']}")
             return None
             
-        product["variant_id"] = variant.id
         return product
-        
-    finally:
-        if session_created:
-            session.close()
+
+def _find_coffee(session, coffee_name: str):
+    """Look up the available variant a coffee name refers to, or None"""
+    # Extract product and variant IDs from coffee name
+    if coffee_name.startswith('['):
+        try:
+            # Extract IDs and title
+            id_end = coffee_name.index(']')
+            ids = coffee_name[1:id_end].split(',')
+            product_id = int(ids[0])
+            variant_id = int(ids[1])
+            title = coffee_name[id_end + 2:]  # Skip "] " to get title
+            
+            # Try the exact ID match, falling back to a title match, in one query
+            result = session.execute(COFFEE_BY_ID_OR_TITLE_SELECT, {
+                "product_id": product_id,
+                "variant_id": variant_id,
+                "title": title
+            }).fetchone()
+        except (ValueError, IndexError):
+            result = None
+    else:
+        # Legacy support for coffee names without IDs
+        result = session.execute(COFFEE_BY_TITLE_SELECT, {"title": coffee_name}).fetchone()
+    return result
+
+def _order_history_row(result, order_date: datetime) -> Dict[str, Any]:
+    """Build an order_history row from a _find_coffee result"""
+    return {
+        "product_id": result.product_id,
+        "variant_id": result.variant_id,
+        "order_date": order_date,
+        "quantity": 1,
+        "price_paid": result.price_paid,
+        "roaster_name": result.roaster_name,
+        "product_title": result.parent_title,
+        "product_url": result.product_url,
+        "option1": result.option1,
+        "option2": result.option2,
+        "option3": result.option3,
+        "is_single_origin": result.is_single_origin,
+        "origin_country": result.origin_country,
+        "origin_region": result.origin_region,
+        "roast_level": result.roast_level,
+        "processing_method": result.processing_method,
+        "varietals": result.varietals,
+        "altitude": result.altitude,
+        "farm": result.farm,
+        "producer": result.producer,
+        # Raw SQL returns the JSON column as text, so decode it rather than storing an encoded string
+        "tasting_notes": json.loads(result.tasting_notes) if result.tasting_notes else None
+    }
+
+def add_coffee_orders(orders):
+    """Add several (coffee_name, order_date) orders to the order history in one transaction"""
+    with get_session() as session:
+        try:
+            rows = []
+            for coffee_name, order_date in orders:
+                result = _find_coffee(session, coffee_name)
+                if not result:
+                    raise ValueError(f"Could not find product matching \"{coffee_name}\"")
+                rows.append(_order_history_row(result, order_date))
+            if not rows:
+                return
+
+            # One Core executemany insert, skipping the ORM unit of work
+            order_table = OrderHistory.__table__
+            order_ids = session.execute(order_table.insert().returning(order_table.c.id), rows).scalars().all()
+            session.commit()
+            add_to_order_history_mat(session, order_ids)
+            for row in rows:
+                print(f"\nAdded {row['roaster_name']} - {row['product_title']} to order history")
+
+        except Exception as e:
+            session.rollback()
+            raise e
 
 def add_coffee_order(coffee_name: str, order_date: datetime):
     """Add a coffee order to the order history"""
-    session = get_session()
-    
-    try:
-        # Extract product and variant IDs from coffee name
-        if coffee_name.startswith('['):
-            try:
-                # Extract IDs and title
-                id_end = coffee_name.index(']')
-                ids = coffee_name[1:id_end].split(',')
-                product_id = int(ids[0])
-                variant_id = int(ids[1])
-                title = coffee_name[id_end + 2:]  # Skip "] " to get title
-                
-                # First try exact ID match
-                query = text("""
-                    SELECT 
-                        wb.product_id,
-                        wb.variant_id,
-                        r.description as roaster_name,
-                        wb.parent_title,
-                        wb.url as product_url,
-                        v.option1,
-                        v.option2,
-                        v.option3,
-                        wb.price as price_paid,
-                        ed.is_single_origin,
-                        wb.origin_country,
-                        ed.origin_region,
-                        ed.roast_level,
-                        wb.processing_method,
-                        ed.varietals,
-                        ed.altitude,
-                        ed.farm,
-                        ed.producer,
-                        wb.tasting_notes
-                    FROM available_options_view wb
-                    JOIN roasters r ON wb.roaster_name = r.name
-                    JOIN variants v ON wb.product_id = v.product_id AND wb.variant_id = v.id
-                    LEFT JOIN product_extended_details ed ON wb.product_id = ed.product_id
-                    WHERE wb.product_id = :product_id
-                    AND wb.variant_id = :variant_id
-                    LIMIT 1
-                """)
-                result = session.execute(query, {
-                    "product_id": product_id,
-                    "variant_id": variant_id
-                }).fetchone()
-                
-                # If ID match fails, try title match
-                if not result:
-                    query = text("""
-                        SELECT 
-                            wb.product_id,
-                            wb.variant_id,
-                            r.description as roaster_name,
-                            wb.parent_title,
-                            wb.url as product_url,
-                            v.option1,
-                            v.option2,
-                            v.option3,
-                            wb.price as price_paid,
-                            ed.is_single_origin,
-                            wb.origin_country,
-                            ed.origin_region,
-                            ed.roast_level,
-                            wb.processing_method,
-                            ed.varietals,
-                            ed.altitude,
-                            ed.farm,
-                            ed.producer,
-                            wb.tasting_notes
-                        FROM available_options_view wb
-                        JOIN roasters r ON wb.roaster_name = r.name
-                        JOIN variants v ON wb.product_id = v.product_id AND wb.variant_id = v.id
-                        LEFT JOIN product_extended_details ed ON wb.product_id = ed.product_id
-                        WHERE wb.parent_title = :title
-                        AND v.option2 = 'Whole Bean'
-                        LIMIT 1
-                    """)
-                    result = session.execute(query, {"title": title}).fetchone()
-            except (ValueError, IndexError):
-                result = None
-        else:
-            # Legacy support for coffee names without IDs
-            query = text("""
-                SELECT 
-                    wb.product_id,
-                    wb.variant_id,
-                    r.description as roaster_name,
-                    wb.parent_title,
-                    wb.url as product_url,
-                    v.option1,
-                    v.option2,
-                    v.option3,
-                    wb.price as price_paid,
-                    ed.is_single_origin,
-                    wb.origin_country,
-                    ed.origin_region,
-                    ed.roast_level,
-                    wb.processing_method,
-                    ed.varietals,
-                    ed.altitude,
-                    ed.farm,
-                    ed.producer,
-                    wb.tasting_notes
-                FROM available_options_view wb
-                JOIN roasters r ON wb.roaster_name = r.name
-                JOIN variants v ON wb.product_id = v.product_id AND wb.variant_id = v.id
-                LEFT JOIN product_extended_details ed ON wb.product_id = ed.product_id
-                WHERE wb.parent_title = :title
-                AND v.option2 = 'Whole Bean'
-                LIMIT 1
-            """)
-            result = session.execute(query, {"title": coffee_name}).fetchone()
-        
-        if not result:
-            raise ValueError(f"Could not find product matching \"{coffee_name}\"")
-        
-        # Create new order history entry
-        order = OrderHistory(
-            product_id=result.product_id,
-            variant_id=result.variant_id,
-            order_date=order_date,
-            quantity=1,
-            price_paid=result.price_paid,
-            roaster_name=result.roaster_name,
-            product_title=result.parent_title,
-            product_url=result.product_url,
-            option1=result.option1,
-            option2=result.option2,
-            option3=result.option3,
-            is_single_origin=result.is_single_origin,
-            origin_country=result.origin_country,
-            origin_region=result.origin_region,
-            roast_level=result.roast_level,
-            processing_method=result.processing_method,
-            varietals=result.varietals,
-            altitude=result.altitude,
-            farm=result.farm,
-            producer=result.producer,
-            tasting_notes=result.tasting_notes
-        )
-        
-        session.add(order)
-        session.commit()
-        print(f"\nAdded {result.roaster_name} - {result.parent_title} to order history")
-        
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+    add_coffee_orders([(coffee_name, order_date)])
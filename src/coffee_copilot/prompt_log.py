@@ -0,0 +1,49 @@
+import atexit
+import queue
+import threading
+import time
+from typing import NamedTuple
+
+# Dumps are dropped rather than blocking the caller once this many are waiting to be written
+MAX_PENDING = 1024
+
+# How long the interpreter waits at exit for queued dumps to be written
+EXIT_TIMEOUT_SECONDS = 5
+
+class LogItem(NamedTuple):
+    path: str
+    body: str
+
+# Prompt dumps are written by a background thread so model calls never wait on disk
+_log_q = queue.Queue(maxsize=MAX_PENDING)
+
+def _write_prompt_logs():
+    """Drain the prompt log queue, writing one file per item"""
+    while True:
+        item = _log_q.get()
+        try:
+            with open(item.path, "w", encoding="utf-8") as f:
+                f.write(item.body)
+        except Exception as e:
+            # Keep the writer alive, so later dumps are still written and flush() can finish
+            print(f"Error writing prompt log {item.path}: {str(e)}")
+        finally:
+            _log_q.task_done()
+
+def write(path: str, body: str):
+    """Queue a prompt dump to be written to path"""
+    # Drop the dump rather than block if the writer has fallen behind
+    try:
+        _log_q.put_nowait(LogItem(path, body))
+    except queue.Full:
+        pass
+
+def flush(timeout: float = EXIT_TIMEOUT_SECONDS):
+    """Wait for queued dumps to be written, giving up after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while _log_q.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+threading.Thread(target=_write_prompt_logs, daemon=True).start()
+# Let queued dumps finish before the interpreter exits
+atexit.register(flush)
@@ -2,31 +2,34 @@ import os
 import json
 import sys
 from datetime import datetime
-from dotenv import load_dotenv
-from coffee_copilot.database import get_session
+from coffee_copilot.database import get_session, session_scope, WHOLE_BEANS_GENERATION_KEY
 from sqlalchemy import text
-from openai import AzureOpenAI
-import yaml
+from coffee_copilot.config import get_config
+from coffee_copilot.openai_client import get_client
+from coffee_copilot import prompt_log
 import logging
 
+# The options prompt block only changes when whole_beans_mat is refreshed or an order is added
+OPTIONS_STATE_SELECT = text("""
+    SELECT
+        (SELECT value FROM schema_meta WHERE key = :generation_key) as generation,
+        (SELECT COUNT(*) FROM order_history) as order_count,
+        (SELECT MAX(id) FROM order_history) as last_order_id
+""")
+
+# Maps that state to (option count, rendered options block), so repeat recommendations skip rebuilding it
+_options_cache = {}
+
 class CoffeeRecommender:
     def __init__(self):
         """Initialize the coffee recommendation system"""
-        # Load environment variables
-        load_dotenv()
+        # Config and the Azure OpenAI client are loaded once per process and shared
+        self.config = get_config()
+        self.monthly_budget = self.config['preferences']['monthly_budget']
+        self.budget_flexibility = self.config['preferences']['budget_flexibility']
         
-        # Load config
-        with open('config.yaml', 'r') as f:
-            self.config = yaml.safe_load(f)
-            self.monthly_budget = self.config['preferences']['monthly_budget']
-            self.budget_flexibility = self.config['preferences']['budget_flexibility']
-        
-        # Initialize Azure OpenAI client
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+        # The shared client loads the environment variables on first use
+        self.client = get_client()
         
         self.deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT")
         
@@ -35,18 +38,27 @@ class CoffeeRecommender:
         os.makedirs(self.prompt_log_dir, exist_ok=True)
     
     def _dump_prompt(self, prompt: str, context: str):
-        """Dump prompt to a file for debugging"""
+        """Queue a prompt dump to a file for debugging"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"{self.prompt_log_dir}/{timestamp}_recommendation.txt"
-        
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write("=== CONTEXT ===\n")
-            f.write(context + "\n\n")
-            f.write("=== PROMPT ===\n")
-            f.write(prompt)
+        prompt_log.write(filename, "=== CONTEXT ===\n" + context + "\n\n=== PROMPT ===\n" + prompt)
             
-    def get_order_history(self):
-        session = get_session()
+    def _fetch_rows(self, session, query):
+        """Run a query and return its rows as dicts, with the tasting notes JSON decoded"""
+        result = session.execute(query).yield_per(256)
+        columns = list(result.keys())
+        notes_index = columns.index('tasting_notes')
+
+        # Stream the rows in batches, zipping each against the column names read once
+        records = []
+        for row in result:
+            record = dict(zip(columns, row))
+            note = row[notes_index]
+            record['tasting_notes'] = json.loads(note) if note else note
+            records.append(record)
+        return records
+
+    def get_order_history(self, session=None):
         query = text("""
             SELECT 
                 oh.product_id,
@@ -60,64 +72,92 @@ class CoffeeRecommender:
                 oh.price_paid as price,
                 p.url
             FROM order_history oh
-            JOIN whole_beans_view wb ON oh.product_id = wb.product_id
+            JOIN whole_beans_mat wb ON oh.product_id = wb.product_id
             JOIN products p ON wb.product_id = p.id
             JOIN roasters r ON p.roaster_id = r.id
             ORDER BY oh.order_date DESC
         """)
-        results = session.execute(query)
-        rows = []
-        for row in results:
-            row_dict = dict(row._mapping)
-            if row_dict['tasting_notes']:
-                row_dict['tasting_notes'] = json.loads(row_dict['tasting_notes'])
-            rows.append(row_dict)
-        return rows
+        with session_scope(session) as session:
+            history = self._fetch_rows(session, query)
+
+        # Parse each order date once here so callers get datetimes
+        for order in history:
+            order['order_date'] = self.parse_date(order['order_date'])
+        return history
+
+    def get_distribution(self, session=None):
+        """Return the roaster, origin and process counts in the order history, most frequent first"""
+        query = text("""
+            WITH history AS (
+                SELECT 
+                    oh.product_id,
+                    r.description as roaster_name,
+                    wb.origin_country,
+                    wb.processing_method
+                FROM order_history oh
+                JOIN whole_beans_mat wb ON oh.product_id = wb.product_id
+                JOIN products p ON wb.product_id = p.id
+                JOIN roasters r ON p.roaster_id = r.id
+            )
+            SELECT 'roaster' as kind, roaster_name as name, COUNT(*) as n
+            FROM history GROUP BY roaster_name
+            UNION ALL
+            SELECT 'origin', origin_country, COUNT(*)
+            FROM history WHERE origin_country != '' GROUP BY origin_country
+            UNION ALL
+            SELECT 'process', processing_method, COUNT(*)
+            FROM history WHERE processing_method != '' GROUP BY processing_method
+            ORDER BY kind, n DESC, name
+        """)
+        counts = {'roaster': [], 'origin': [], 'process': []}
+        with session_scope(session) as session:
+            for row in session.execute(query):
+                counts[row.kind].append((row.name, row.n))
+        return counts['roaster'], counts['origin'], counts['process']
 
     def parse_date(self, date_str):
         """Parse date string into datetime object"""
         if isinstance(date_str, str):
-            try:
-                return datetime.strptime(date_str, '%Y-%m-%d')
-            except ValueError:
-                return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S.%f')
+            return datetime.fromisoformat(date_str)
         return date_str
 
-    def get_monthly_spend(self, history, year, month):
-        """Calculate total spend for a specific month"""
-        total = 0
-        for order in history:
-            order_date = self.parse_date(order['order_date'])
-            if order_date.year == year and order_date.month == month:
-                total += order['price']
-        return total
+    def get_monthly_spend_map(self, session=None):
+        """Return total spend keyed by (year, month), summed by SQLite"""
+        query = text("""
+            SELECT 
+                CAST(strftime('%Y', order_date) AS INTEGER) as year,
+                CAST(strftime('%m', order_date) AS INTEGER) as month,
+                SUM(price_paid) as total
+            FROM order_history
+            GROUP BY year, month
+        """)
+        with session_scope(session) as session:
+            return {(row.year, row.month): row.total for row in session.execute(query)}
 
-    def get_spending_summary(self, history):
+    def get_spending_summary(self, session=None):
         """Generate a summary of recent spending"""
+        monthly = self.get_monthly_spend_map(session)
         now = datetime.now()
-        current_month_spend = self.get_monthly_spend(history, now.year, now.month)
-        last_month_spend = self.get_monthly_spend(history, now.year if now.month > 1 else now.year - 1, 
-                                           now.month - 1 if now.month > 1 else 12)
-        
-        # Get last 3 months average (excluding current month)
-        three_month_total = 0
-        for i in range(1, 4):
-            month = now.month - i
-            year = now.year
-            if month <= 0:
-                month += 12
-                year -= 1
-            three_month_total += self.get_monthly_spend(history, year, month)
-        
+
+        def spend(months_ago):
+            year, month = divmod(now.year * 12 + now.month - 1 - months_ago, 12)
+            return monthly.get((year, month + 1), 0)
+
         return {
-            'current_month': current_month_spend,
-            'last_month': last_month_spend,
-            'three_month_average': three_month_total / 3
+            'current_month': spend(0),
+            'last_month': spend(1),
+            'three_month_average': sum(spend(i) for i in range(1, 4)) / 3
         }
 
-    def get_available_options(self):
-        session = get_session()
-        query = text("""
+    def format_recent_orders(self, history, limit=5):
+        """Format the most recent orders as display lines"""
+        return [
+            f"{coffee['order_date'].strftime('%Y-%m-%d')}: {coffee['roaster_name']} - {coffee['parent_title']} (${coffee['price']:.2f})"
+            for coffee in history[:limit]
+        ]
+
+    def get_available_options(self, session=None, exclude_ordered=True):
+        query = """
             SELECT 
                 wb.product_id,
                 wb.variant_id,
@@ -130,64 +170,52 @@ class CoffeeRecommender:
                 wb.url
             FROM available_options_view wb
             JOIN roasters r ON wb.roaster_name = r.name
-            ORDER BY r.description
-        """)
+        """
+        # The view only drops ordered variants; also drop products ordered in any size
+        if exclude_ordered:
+            query += " WHERE NOT EXISTS (SELECT 1 FROM order_history oh WHERE oh.product_id = wb.product_id)"
+        query += " ORDER BY r.description"
         
-        results = session.execute(query)
-        rows = []
-        for row in results:
-            row_dict = dict(row._mapping)
-            if row_dict['tasting_notes']:
-                row_dict['tasting_notes'] = json.loads(row_dict['tasting_notes'])
-            rows.append(row_dict)
-        return rows
+        with session_scope(session) as session:
+            return self._fetch_rows(session, text(query))
+
+    def get_options_block(self, session=None):
+        """Return the number of available options and their prompt lines, reused while the options are unchanged"""
+        with session_scope(session) as session:
+            state = tuple(session.execute(OPTIONS_STATE_SELECT, {"generation_key": WHOLE_BEANS_GENERATION_KEY}).one())
+            cached = _options_cache.get(state)
+            if cached is None:
+                options = self.get_available_options(session)
+                cached = (len(options), "\n".join(self.format_coffee_data(coffee) for coffee in options))
+                _options_cache.clear()
+                _options_cache[state] = cached
+            return cached
 
     def format_coffee_data(self, coffee):
         """Format coffee data into a readable string"""
-        parts = [
-            f"[{coffee['product_id']},{coffee['variant_id']}] {coffee['roaster_name']} - {coffee['parent_title']}",
-            f"Origin: {coffee['origin_country'] or 'Unknown'}"
-        ]
-        
-        if coffee['processing_method']:
-            parts.append(f"Process: {coffee['processing_method']}")
-        if coffee['tasting_notes']:
-            parts.append(f"Tasting notes: {coffee['tasting_notes']}")
-        parts.append(f"Price: ${coffee['price']:.2f}")
-        parts.append(f"URL: {coffee['url']}")
-        
-        return " | ".join(parts)
+        # Built as one concatenation rather than a list of parts joined afterwards
+        return (
+            f"[{coffee['product_id']},{coffee['variant_id']}] {coffee['roaster_name']} - {coffee['parent_title']}"
+            f" | Origin: {coffee['origin_country'] or 'Unknown'}"
+            + (f" | Process: {coffee['processing_method']}" if coffee['processing_method'] else "")
+            + (f" | Tasting notes: {coffee['tasting_notes']}" if coffee['tasting_notes'] else "")
+            + f" | Price: ${coffee['price']:.2f} | URL: {coffee['url']}"
+        )
 
     def get_recommendation(self):
-        # Get data
-        history = self.get_order_history()
-        options = self.get_available_options()
-        spending = self.get_spending_summary(history)
+        # Get data, reading history, options, spending and distribution through one session
+        with get_session() as session:
+            history = self.get_order_history(session)
+            option_count, options_formatted = self.get_options_block(session)
+            spending = self.get_spending_summary(session)
+            roaster_counts, origin_counts, process_counts = self.get_distribution(session)
         
         # Calculate remaining budget
         remaining_budget = self.monthly_budget - spending['current_month']
         max_price = self.monthly_budget * (1 + self.budget_flexibility)
         
-        # Analyze current distribution
-        roaster_counts = {}
-        origin_counts = {}
-        process_counts = {}
-        ordered_product_ids = set()
-        
-        for coffee in history:
-            ordered_product_ids.add(coffee['product_id'])
-            roaster_counts[coffee['roaster_name']] = roaster_counts.get(coffee['roaster_name'], 0) + 1
-            if coffee['origin_country']:
-                origin_counts[coffee['origin_country']] = origin_counts.get(coffee['origin_country'], 0) + 1
-            if coffee['processing_method']:
-                process_counts[coffee['processing_method']] = process_counts.get(coffee['processing_method'], 0) + 1
-        
-        # Filter out ordered coffees from options
-        available_options = [opt for opt in options if opt['product_id'] not in ordered_product_ids]
-        
-        # Format history and options
+        # Format history (the options block comes ready rendered)
         history_formatted = "\n".join(self.format_coffee_data(coffee) for coffee in history[:5])
-        options_formatted = "\n".join(self.format_coffee_data(coffee) for coffee in available_options)
         
         # Format the prompt
         prompt = f"""You are a coffee expert helping select the next coffee to try. Your goal is to help the user explore new and different coffee experiences.
@@ -203,9 +231,9 @@ Available options to choose from - You MUST select from this list:
 Based on the order history and available options, recommend ONE coffee that would maximize variety in terms of roaster, origin, processing method, and tasting notes.
 
 Current distribution in order history:
-- Most frequent roasters: {', '.join(f'{k} ({v}x)' for k, v in sorted(roaster_counts.items(), key=lambda x: x[1], reverse=True)[:3])}
-- Most frequent origins: {', '.join(f'{k} ({v}x)' for k, v in sorted(origin_counts.items(), key=lambda x: x[1], reverse=True)[:3])}
-- Processing methods used: {', '.join(f'{k} ({v}x)' for k, v in sorted(process_counts.items(), key=lambda x: x[1], reverse=True))}
+- Most frequent roasters: {', '.join(f'{k} ({v}x)' for k, v in roaster_counts[:3])}
+- Most frequent origins: {', '.join(f'{k} ({v}x)' for k, v in origin_counts[:3])}
+- Processing methods used: {', '.join(f'{k} ({v}x)' for k, v in process_counts)}
 
 Budget Considerations:
 - Monthly budget: ${self.monthly_budget:.2f}
@@ -223,8 +251,8 @@ CRITICAL INSTRUCTIONS:
 7. Do not include headings or sections
 8. Do not mention price unless it's a special coffee that exceeds the monthly budget"""
         
-        # Save prompt for debugging (silently)
-        context = f"Order History: {len(history)} orders\nAvailable Options: {len(options)} coffees\nCurrent Month Spend: ${spending['current_month']:.2f}\nRemaining Budget: ${remaining_budget:.2f}"
+        # Save prompt for debugging (silently, written while the model responds)
+        context = f"Order History: {len(history)} orders\nAvailable Options: {option_count} coffees\nCurrent Month Spend: ${spending['current_month']:.2f}\nRemaining Budget: ${remaining_budget:.2f}"
         self._dump_prompt(prompt, context)
         
         # Get recommendation from GPT-4
@@ -243,7 +271,7 @@ def main():
         
         # Get and display spending summary
         history = recommender.get_order_history()
-        spending = recommender.get_spending_summary(history)
+        spending = recommender.get_spending_summary()
         
         print("\nSpending Summary:")
         print("-" * 50)
@@ -254,9 +282,7 @@ def main():
         # Display recent orders
         print("\nRecent Orders:")
         print("-" * 50)
-        for coffee in history[:5]:
-            order_date = recommender.parse_date(coffee['order_date']).strftime('%Y-%m-%d')
-            print(f"{order_date}: {coffee['roaster_name']} - {coffee['parent_title']} (${coffee['price']:.2f})")
+        print("\n".join(recommender.format_recent_orders(history)))
         
         # Get and display recommendation
         print("\nRecommended Coffee:")